@@ -373,7 +373,7 @@ class StartupTask:
             paths = [i.replace('\\', '/') for i in paths]
             with open(pjoin(startup_dir, 'EmailBlocker.bat'), 'w', encoding='utf-8') as f:
                 f.write(
-                    f'@echo off\nstart "EmailBlocker" "{paths[0]}" "{paths[1]}" -f'
+                    f'@echo off\nstart "EmailBlocker" "{paths[0]}" "{paths[1]}" -f --incremental'
                 )
             output('Startup task created!', 'green')
         except Exception as e:
@@ -465,12 +465,17 @@ class StartupTask:
             output(f'Failed to update startup tasks: {e}', 'red')
 
 
-def run(skip_confirm=False):
+def run(skip_confirm=False, explain=False, jobs=1, incremental=False, full_scan_every=None, daemon=False):
     '''
     Runs the email deleting process using the current settings
 
     Args:
         skip_confirm (bool): whether to skip the "Are you sure you want to delete these emails" prompt
+        explain (bool): just output the commands that would be sent to the server and don't delete anything
+        jobs (int): the number of labels to work on at once, each using a separate connection
+        incremental (bool): only search emails that have arrived since the last run
+        full_scan_every (int): when running incrementally, search everything after this many incremental runs
+        daemon (bool): keep running afterwards and delete new emails as soon as they arrive
     '''
     try:
         config = get_settings()
@@ -482,74 +487,100 @@ def run(skip_confirm=False):
             output('Cannot filter emails: Invalid password', 'red')
             return
 
-        with filter_emails.Server() as server:
+        # emails that have been seen before are cached so they don't need to be downloaded again
+        cache_file = os.path.join(os.path.dirname(__file__), 'cache.db')
+        with filter_emails.EmailCache(cache_file) as cache, filter_emails.ServerPool(
+            config['user_email'], config['user_password'], max_connections=jobs, uid=True, cache=cache
+        ) as server:
             output(f'Logging into GMAIL with user {config["user_email"]}')
             try:
-                server.login(config['user_email'], config['user_password'])
+                with server.session() as session:
+                    labels = session.get_labels()
+                    special_labels = session.special_labels
             except Exception as e:
                 output(f'Failed to log in: {e}', 'red')
                 return
 
-            email_ids = []
-            for filter in config['filters']:
-                output(f'Searching for emails that match "{filter["search"]}" in label "{filter["label"]}"')
-                try:
-                    server.select_label(filter['label'])
-                except Exception as e:
-                    output(f'Failed to select label "{filter["label"]}": {e}', 'red')
-                else:
-                    email_ids += server.search(
-                        filter['search'], **filter
-                    )
+            plan = filter_emails.ExecutionPlan(
+                config['filters'], labels, incremental=incremental, full_scan_every=full_scan_every,
+                special_labels=special_labels
+            )
+            if explain:
+                output(plan.explain())
+                return
 
-            output(
-                (
-                    f'Found {len(email_ids)} email{"s" if len(email_ids) > 1 or len(email_ids) == 0 else ""}, '
-                    'grabbing data from server'
-                )
+            msg = []
+            grabbed = 0
+
+            def preview(label, e):
+                nonlocal grabbed
+                grabbed += 1
+                # only the first few are listed so that the preview doesn't grow with the size of the mailbox
+                if len(msg) < filter_emails.PREVIEW_LIMIT:
+                    msg.append(f"From {e['from']['email']} to {e['to']}\n\tSubject: {e['subject']}\n\n")
+                output(f'Grabbing email data ({grabbed})')
+
+            # if we don't need to confirm then emails are deleted as soon as each label has been searched
+            email_ids = plan.execute(
+                server,
+                commit=skip_confirm,
+                on_email=None if skip_confirm else preview,
+                output=output,
+                error=lambda e: output(e, 'red')
             )
+            total = sum(len(i) for i in email_ids.values())
+            if total > len(msg):
+                msg.append(f'...and {total - len(msg)} more\n')
 
-            if len(email_ids) > 0:
-                if not skip_confirm:
-                    msg = []
-                    tmp = 1
-                    for e in server.get_emails_by_id(email_ids, generator=True):
-                        output(f'Grabbing email data ({tmp}/{len(email_ids)})')
-                        msg.append(f"From {e['from']['email']} to {e['to']}\n\tSubject: {e['subject']}\n\n")
-                        tmp += 1
+            output(f'Found {total} email{"s" if total > 1 or total == 0 else ""}')
 
-                    try:
-                        msg_box = gui.scrollable_popup_yn(msg, title='Delete these emails?')
-                    except Exception:
-                        for i in msg:
-                            print(i)
-                        while True:
-                            inp = input('Delete these emails? (y/n) : ')
-                            if inp.lower() == 'y':
-                                msg_box = True
-                                break
-                            elif inp.lower() == 'n':
-                                msg_box = False
-                                break
-                            else:
-                                print('Invalid respone\n')
-                if msg_box or skip_confirm:
-                    for i in range(len(email_ids)):
-                        output(
-                            (
-                                f'Sending {len(email_ids)} email{"s" if len(email_ids) > 1 else ""}'
-                                f' to the bin ({i+1}/{len(email_ids)})'
-                            )
-                        )
-                        server.delete_email(email_ids[i])
+            if total > 0 and not skip_confirm:
+                try:
+                    msg_box = gui.scrollable_popup_yn(msg, title='Delete these emails?')
+                except Exception:
+                    for i in msg:
+                        print(i)
+                    while True:
+                        inp = input('Delete these emails? (y/n) : ')
+                        if inp.lower() == 'y':
+                            msg_box = True
+                            break
+                        elif inp.lower() == 'n':
+                            msg_box = False
+                            break
+                        else:
+                            print('Invalid respone\n')
+                if msg_box:
+                    plan.commit(server, email_ids, output=output, error=lambda e: output(e, 'red'))
                 else:
                     output('Cancelled. Removed 0 emails', 'green')
                     return
+            elif not skip_confirm:
+                # nothing to delete but the labels still need marking as searched
+                plan.commit(server, email_ids, output=output, error=lambda e: output(e, 'red'))
 
-        output(
-            f'Done! Removed {len(email_ids)} email{"s" if len(email_ids) > 1 or len(email_ids) == 0 else ""}',
-            'green'
-        )
+            output(
+                f'Done! Removed {total} email{"s" if total > 1 or total == 0 else ""}',
+                'green'
+            )
+            traffic = server.traffic
+            if traffic['received'] > traffic['received_wire']:
+                output(
+                    f'Downloaded {traffic["received_wire"] // 1024}KB ({traffic["received"] // 1024}KB uncompressed)'
+                )
+            for stage, stats in server.throughput.items():
+                if stats['items'] and stats['seconds']:
+                    output(
+                        f'{stage.capitalize()}: {stats["items"]} emails in {stats["seconds"]:.1f}s '
+                        f'({stats["items"] / stats["seconds"]:.0f}/s)'
+                    )
+
+            if daemon:
+                output('Watching for new emails. Press Ctrl+C to stop')
+                try:
+                    plan.watch(server, output=output, error=lambda e: output(e, 'red'))
+                except KeyboardInterrupt:
+                    pass
     except Exception as e:
         output(f'Failed: {e}', 'red')
 
@@ -667,6 +698,7 @@ def validate_filter(filter: dict, sub=False):
 
     Raises:
         TypeError: if part of the filter contains invalid types
+        ValueError: if the filter is a regular expression that can't be used (see `filter_emails.check_pattern`)
 
     Returns:
         dict: the validated filter
@@ -680,7 +712,8 @@ def validate_filter(filter: dict, sub=False):
         ('body', False),
         ('label', 'Inbox'),
         ('all_match', True),
-        ('exact_match', True)
+        ('exact_match', True),
+        ('regex', False)
     ):
         if i[0] not in filter.keys():
             filter[i[0]] = i[1]
@@ -688,6 +721,8 @@ def validate_filter(filter: dict, sub=False):
             raise TypeError(f'filter key "{i[0]}" contains invalid type {type(filter[i[0]])}, expected {type(i[1])}')
         else:
             pass
+    if filter['regex']:
+        filter_emails.check_pattern(filter['search'])
     if sub:
         # only allow the sub-filtering to go 1 level deep
         if 'sub_filters' in filter.keys():
@@ -788,6 +823,10 @@ if __name__ == '__main__':
             '--no-exact-match', action='store_true',
             help='Filter if the field contains the search term even if the two don\'t completely match'
         )
+        parser.add_argument(
+            '--regex', action='store_true',
+            help='Treat the filter as a regular expression to look for in each field'
+        )
         parser.add_argument(
             '--no-all-match', action='store_true',
             help='The query doesn\'t have to appear in ALL specified fields, just one of them'
@@ -796,6 +835,26 @@ if __name__ == '__main__':
             '-y', '--yes', action='store_true',
             help='skip the confirmation prompt'
         )
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='Print the commands that would be sent to the server without deleting anything'
+        )
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help=f'The number of labels to work on at once (max {filter_emails.MAX_CONNECTIONS})'
+        )
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only search emails that have arrived since the last run'
+        )
+        parser.add_argument(
+            '--full-scan-every', type=int, default=None,
+            help='When running with --incremental, search everything after this many incremental runs'
+        )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running and delete new emails as soon as they arrive'
+        )
 
         args = parser.parse_args()
 
@@ -832,7 +891,8 @@ if __name__ == '__main__':
                             'all_match': not args.no_all_match,
                             # we invert args.no_all_match because the default choice is "use ALL matches"
                             # so if "use all matches" is true then "don't use all matches" needs to be false
-                            'exact_match': not args.no_exact_match  # same here
+                            'exact_match': not args.no_exact_match,  # same here
+                            'regex': args.regex
                         }
                     )
                 try:
@@ -841,4 +901,7 @@ if __name__ == '__main__':
                     print(f'Failed to parse config: {e}')
                     sys.exit(1)
         set_settings(config)
-        run(skip_confirm=args.yes)
+        run(
+            skip_confirm=args.yes, explain=args.explain, jobs=args.jobs,
+            incremental=args.incremental, full_scan_every=args.full_scan_every, daemon=args.daemon
+        )
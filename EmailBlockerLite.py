@@ -16,7 +16,8 @@ def validate_filter(filter: dict, sub=False):
         ('body', False),
         ('label', 'Inbox'),
         ('all_match', True),
-        ('exact_match', True)
+        ('exact_match', True),
+        ('regex', False)
     ):
         if i[0] not in filter.keys():
             filter[i[0]] = i[1]
@@ -24,6 +25,8 @@ def validate_filter(filter: dict, sub=False):
             raise TypeError(f'filter key "{i[0]}" contains invalid type {type(filter[i[0]])}, expected {type(i[1])}')
         else:
             pass
+    if filter['regex']:
+        filter_emails.check_pattern(filter['search'])
     if sub:
         # only allow the sub-filtering to go 1 level deep
         if 'sub_filters' in filter.keys():
@@ -103,10 +106,34 @@ if __name__ == '__main__':
         '--no-exact-match', action='store_true',
         help='Filter if the field contains the search term even if the two don\'t completely match'
     )
+    parser.add_argument(
+        '--regex', action='store_true',
+        help='Treat the filter as a regular expression to look for in each field'
+    )
     parser.add_argument(
         '--no-all-match', action='store_true',
         help='The query doesn\'t have to appear in ALL specified fields, just one of them'
     )
+    parser.add_argument(
+        '--explain', action='store_true',
+        help='Print the commands that would be sent to the server without deleting anything'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help=f'The number of labels to work on at once (max {filter_emails.MAX_CONNECTIONS})'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Only search emails that have arrived since the last run'
+    )
+    parser.add_argument(
+        '--full-scan-every', type=int, default=None,
+        help='When running with --incremental, search everything after this many incremental runs'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running and delete new emails as soon as they arrive'
+    )
 
     args = parser.parse_args()
 
@@ -143,7 +170,8 @@ if __name__ == '__main__':
                         'all_match': not args.no_all_match,
                         # we invert args.no_all_match because the default choice is "use ALL matches"
                         # so if "use all matches" is true then "don't use all matches" needs to be false
-                        'exact_match': not args.no_exact_match  # same here
+                        'exact_match': not args.no_exact_match,  # same here
+                        'regex': args.regex
                     }
                 )
             try:
@@ -152,43 +180,47 @@ if __name__ == '__main__':
                 print(f'Failed to parse config: {e}')
                 sys.exit(1)
 
-    with filter_emails.Server() as server:
+    # emails that have been seen before are cached so they don't need to be downloaded again
+    cache_file = os.path.join(os.path.dirname(__file__), 'cache.db')
+    with filter_emails.EmailCache(cache_file) as cache, filter_emails.ServerPool(
+        config['user_email'], config['user_password'], max_connections=args.jobs, uid=True, cache=cache
+    ) as server:
         print(f'Logging into GMAIL with user {config["user_email"]}')
         try:
-            server.login(config['user_email'], config['user_password'])
+            with server.session() as session:
+                labels = session.get_labels()
+                special_labels = session.special_labels
         except Exception as e:
             print(f'Failed to log in: {e}')
             sys.exit(1)
 
-        email_ids = []
-        for filter in config['filters']:
-            print(f'Searching for emails that match "{filter["search"]}" in label "{filter["label"]}"')
-            try:
-                server.select_label(filter['label'])
-            except Exception as e:
-                print(f'Failed to select label "{filter["label"]}": {e}')
-            else:
-                email_ids += server.search(
-                    filter['search'],
-                    from_=filter['from'],
-                    cc=filter['cc'],
-                    bcc=filter['bcc'],
-                    subject=filter['subject'],
-                    body=filter['body'],
-                    all_match=filter['all_match'],
-                    exact_match=filter['exact_match']
-                )
+        plan = filter_emails.ExecutionPlan(
+            config['filters'], labels, incremental=args.incremental, full_scan_every=args.full_scan_every,
+            special_labels=special_labels
+        )
+        if args.explain:
+            print(plan.explain())
+            sys.exit(0)
 
-        print(f'Found {len(email_ids)} email{"s" if len(email_ids) > 1 or len(email_ids) == 0 else ""}')
+        # each label is searched and has its emails deleted before moving on to the next
+        email_ids = plan.execute(server)
+        total = sum(len(i) for i in email_ids.values())
 
-        if len(email_ids) > 0:
-            for i in range(len(email_ids)):
+        print(f'Removed {total} email{"s" if total > 1 or total == 0 else ""}')
+        print('Done!')
+        traffic = server.traffic
+        if traffic['received'] > traffic['received_wire']:
+            print(f'Downloaded {traffic["received_wire"] // 1024}KB ({traffic["received"] // 1024}KB uncompressed)')
+        for stage, stats in server.throughput.items():
+            if stats['items'] and stats['seconds']:
                 print(
-                    (
-                        f'Sending {len(email_ids)} email{"s" if len(email_ids) > 1 else ""}'
-                        f' to the bin ({i + 1}/{len(email_ids)})'
-                    )
+                    f'{stage.capitalize()}: {stats["items"]} emails in {stats["seconds"]:.1f}s '
+                    f'({stats["items"] / stats["seconds"]:.0f}/s)'
                 )
-                server.delete_email(email_ids[i])
 
-        print('Done!')
+        if args.daemon:
+            print('Watching for new emails. Press Ctrl+C to stop')
+            try:
+                plan.watch(server)
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,145 @@
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.dirname(__file__))
+import filter_emails
+
+
+def make_filters(count, rng):
+    '''
+    Makes a mix of filters like the ones people set up: blocked senders and domains,
+    exact subjects and bodies, and a few regular expressions with sub-filters
+    '''
+    filters = []
+    for i in range(count):
+        kind = i % 5
+        filter = {
+            'search': '', 'from': False, 'cc': False, 'bcc': False, 'subject': False, 'body': False,
+            'all_match': True, 'exact_match': True, 'regex': False, 'sub_filters': []
+        }
+        if kind == 0:
+            filter.update({'search': f'sender{i}@spam{rng.randrange(50)}.com', 'from': True})
+        elif kind == 1:
+            filter.update({'search': f'*@spam{i}.com', 'from': True})
+        elif kind == 2:
+            filter.update({'search': f'Sale number {i}', 'subject': True, 'body': True, 'all_match': False})
+        elif kind == 3:
+            filter.update({'search': f'Weekly digest {i}', 'subject': True, 'cc': True})
+        else:
+            filter.update({'search': rf'order #{i}\d+', 'subject': True, 'regex': True})
+            filter['sub_filters'].append({
+                'search': f'shop{i}.com', 'from': True, 'cc': False, 'bcc': False, 'subject': False, 'body': False,
+                'all_match': True, 'exact_match': False, 'regex': False
+            })
+        filters.append(filter)
+    return filters
+
+
+def make_records(count, rng):
+    '''
+    Makes emails (as returned by `Server.get_emails_by_id`) from a mix of senders, some of which
+    the filters block. Bodies are only digests, like emails from the cache
+    '''
+    records = []
+    for i in range(count):
+        address = f'sender{rng.randrange(200)}@spam{rng.randrange(100)}.com'
+        records.append({
+            'id': i,
+            'from': {'raw': f'Sender <{address}>', 'email': address, 'name': 'Sender', 'address': address},
+            'to': 'me@gmail.com',
+            'cc': None,
+            'bcc': None,
+            'date': 'Mon, 1 Jan 2024 00:00:00 +0000',
+            'subject': rng.choice(('Sale number 7', 'Weekly digest 3', f'Your order #{rng.randrange(100)}42', 'Hello')),
+            'body': None,
+            'body_digest': filter_emails.body_digest(f'Sale number {rng.randrange(100)}')
+        })
+    return records
+
+
+def interpreted_matches(email, filter):
+    '''
+    Checks an email against a filter the way it was done before filters were compiled into a `Predicate`:
+    by looking up each field in the filter and working out sender patterns and body digests for every email.
+    Regular expressions and sub-filters aren't handled. Used as a baseline to compare `Predicate` against
+    '''
+    query = filter['search']
+    for field, _ in filter_emails.SEARCH_KEYS:
+        if not filter.get(field):
+            continue
+        if field == 'from':
+            sender = email['from']
+            if query == sender['raw']:
+                return True
+            if sender['email'] is None:
+                continue
+            address = filter_emails.normalize_address(sender['email'])
+            wildcard = filter_emails.sender_pattern(query)
+            if wildcard is None:
+                if filter_emails.normalize_address(query) == address:
+                    return True
+                continue
+            kind, domain = wildcard
+            sender_domain = address.rpartition('@')[2]
+            if sender_domain == domain if kind == 'domain' else sender_domain.endswith('.' + domain):
+                return True
+        elif field == 'body' and email['body'] is None and email.get('body_digest') is not None:
+            if filter_emails.body_digest(query) == email['body_digest']:
+                return True
+        elif query == email[field]:
+            return True
+    return False
+
+
+def run(label, check, records, total):
+    '''
+    Times `check` over `total` records, reusing `records` as needed
+
+    Returns:
+        int: the number of records that matched
+    '''
+    matched = 0
+    start = time.perf_counter()
+    for e in itertools.islice(itertools.cycle(records), total):
+        if check(e):
+            matched += 1
+    seconds = time.perf_counter() - start
+    print(f'{label}: {total} evaluations in {seconds:.2f}s ({total / seconds:,.0f}/s), {matched} matched')
+    return matched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures how quickly emails can be checked against filters')
+    parser.add_argument(
+        '-n', '--records', type=int, default=1000000,
+        help='The number of emails to check'
+    )
+    parser.add_argument(
+        '--filters', type=int, default=50,
+        help='The number of filters to check each email against'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='The seed for generating the emails and filters'
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    filters = make_filters(args.filters, rng)
+    # emails are generated once and cycled through, so memory doesn't grow with --records
+    records = make_records(min(args.records, 20000), rng)
+    rules = [filter_emails._exact_parts(f) for f in filters]
+
+    print(f'Checking {args.records} emails against {len(filters)} filters')
+    run('Predicate', filter_emails.Predicate(rules), records, args.records)
+
+    # `interpreted_matches` doesn't handle regular expressions, so compare the two without them
+    plain = [parts for parts in rules if not any(f['regex'] for f in parts)]
+
+    def interpreted(e):
+        return any(all(interpreted_matches(e, f) for f in parts) for parts in plain)
+    run('Predicate (no regular expressions)', filter_emails.Predicate(plain), records, args.records)
+    run('Interpreted (no regular expressions)', interpreted, records, args.records)
@@ -1,7 +1,28 @@
-import imaplib
+import asyncio
 import re
+import ssl
+import json
+import sqlite3
+import time
+import hashlib
 import base64
+import quopri
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache
+from heapq import merge
+from itertools import islice
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # before Python 3.11
+    import sre_parse
+from email.header import decode_header, make_header
 from email.parser import HeaderParser
+from email.utils import getaddresses
 
 '''
 Created with inspiration from github user Giovane Liberato
@@ -9,63 +30,465 @@ https://gist.github.com/giovaneliberato/b3ebce305262888633c1
 '''
 
 
-class Server():
-    def __init__(self, username=None, password=None, url='imap.gmail.com'):
+class AsyncServer():
+    def __init__(self, url='imap.gmail.com', port=993, uid=False, window=None, cache=None, compress=True):
         '''
-        Initialize the server
-        If user and password are specified then `self.login` is called
+        An asyncio based connection to the server.
+        Nothing happens until `self.connect` is awaited, which means that many connections
+        (for different labels or even different accounts) can share the same event loop
 
         Args:
-            username (str): the email to sign in as
-            password (str): the password to sign in with
             url (str): the url of the email server (only imap.gmail.com is supported)
+            port (int): the port to connect to (over SSL)
+            uid (bool): address emails by UID (`UID SEARCH`, `UID FETCH`, `UID STORE`) rather than
+                by sequence number. UIDs don't change when other emails are deleted so they can
+                be safely batched together
+            window (int): the max number of FETCH/STORE commands to have in flight at once.
+                Defaults to `PIPELINE_WINDOW`. 1 waits for each command to complete before sending the next
+            cache (EmailCache): where to cache the info of fetched emails. Only used when `uid` is set
+            compress (bool): compress the connection (RFC 4978) once logged in, if the server supports it
         '''
+        self.url = url
+        self.port = port
+        self.uid = uid
+        self.window = max(1, PIPELINE_WINDOW if window is None else window)
+        self.cache = cache
+        self.compress = compress
         self.logged_in = False
         self.labels = None
-        self.server = imaplib.IMAP4_SSL(url)
-        if username is not None and password is not None:
-            self.login(username, password)
+        self.special_labels = {}
+        # the currently selected label (see `self.select_label`)
+        self.label = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestmodseq = None
+        # see `self.get_capabilities` and `self.enable`
+        self.capabilities = None
+        self.enabled = set()
+        self.reader = None
+        self.writer = None
+        # the number of bytes sent and received, before ('sent', 'received') and after ('sent_wire',
+        # 'received_wire') compression. The two are the same until `self.start_compression` is called
+        self.traffic = dict.fromkeys(('sent', 'sent_wire', 'received', 'received_wire'), 0)
+        # the number of emails that have gone through each stage of a search and how long it took (see `self._record`)
+        self.throughput = {stage: {'items': 0, 'seconds': 0} for stage in PIPELINE_STAGES}
+        self.__deflate = None
+        self.__inflate = None
+        self.__buffer = bytearray()
+        self.__tag = 0
+        # tagged responses that arrived before the responses of older commands
+        self.__completed = {}
+        # created on first use so that it belongs to whichever loop the connection runs on
+        self.__lock = None
 
-    def __enter__(self, username=None, password=None, label='inbox'):
-        if username is not None and password is not None:
-            self.login(username, password)
-            self.select_label(label)
+    async def __aenter__(self):
+        await self.connect()
         return self
 
-    def login(self, username, password):
+    async def __aexit__(self, *args, **kwargs):
+        await self.close()
+
+    async def connect(self):
         '''
-        Logs a user into the server
+        Opens the connection to the server and waits for its greeting
+        '''
+        self.reader, self.writer = await asyncio.open_connection(
+            self.url, self.port, ssl=ssl.create_default_context()
+        )
+        tag, kind, data = await self._read_response()
+        if tag != '*' or kind not in ('OK', 'PREAUTH'):
+            raise Exception(f'Unexpected greeting from server: {_response_text(data)}')
+
+    async def _fill(self):
+        '''
+        Internal function to read the next chunk of data from the server into the buffer
+        '''
+        data = await self.reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError('Connection to the server was lost')
+        self.traffic['received_wire'] += len(data)
+        if self.__inflate is not None:
+            # this can be empty if the chunk ended part way through a deflate block
+            data = self.__inflate.decompress(data)
+        self.traffic['received'] += len(data)
+        self.__buffer += data
+
+    def _write(self, data):
+        '''
+        Internal function to write data to the server, compressing it if `self.start_compression` has been called
+        '''
+        self.traffic['sent'] += len(data)
+        if self.__deflate is not None:
+            # each write is flushed so the server can act on it without waiting for more
+            data = self.__deflate.compress(data) + self.__deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.traffic['sent_wire'] += len(data)
+        self.writer.write(data)
+
+    async def _readline(self):
+        '''
+        Internal function to read a line (without the CRLF) from the server
+        '''
+        start = 0
+        while True:
+            end = self.__buffer.find(b'\r\n', start)
+            if end != -1:
+                line = bytes(self.__buffer[:end])
+                del self.__buffer[:end + 2]
+                return line
+            # the CR may be the last byte we have so far
+            start = max(0, len(self.__buffer) - 1)
+            await self._fill()
+
+    async def _readexactly(self, size):
+        '''
+        Internal function to read a set number of bytes from the server
+        '''
+        while len(self.__buffer) < size:
+            await self._fill()
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+    async def _read_response(self):
+        '''
+        Internal function to read a single response (including any literals) from the server
+
+        Returns:
+            tuple: the tag ('*' for untagged responses and '+' for continuations),
+                the type of the response (eg: 'FETCH', 'SEARCH' or 'OK') and the response data.
+                The data is in the same format imaplib uses: a list of bytes, with literals
+                given as tuples of the text before them and the literal itself
+        '''
+        parts = []
+        line = await self._readline()
+        while True:
+            match = LITERAL_REGEX.search(line)
+            if match is None:
+                parts.append(line)
+                break
+            literal = await self._readexactly(int(match.group(1)))
+            parts.append((line, literal))
+            line = await self._readline()
+
+        first = parts[0][0] if type(parts[0]) == tuple else parts[0]
+        if first.startswith(b'+'):
+            return '+', None, parts
+        match = RESPONSE_REGEX.match(first)
+        if match is None:
+            raise Exception(f'Could not parse response from server: {first!r}')
+        tag, number, kind, rest = match.groups()
+        # for responses like "* 12 FETCH (...)" the number is kept as part of the data, like imaplib does
+        if number is not None:
+            rest = number + (b' ' + rest if rest else b'')
+        parts[0] = (rest, parts[0][1]) if type(parts[0]) == tuple else rest
+        return tag.decode(), kind.decode().upper(), parts
+
+    def _record(self, stage, items, start):
+        '''
+        Internal function to add to the throughput of a stage (see `PIPELINE_STAGES`)
+
+        Args:
+            stage (str): the stage, eg: 'fetch'
+            items (int): the number of emails that went through the stage
+            start (float): when the stage started work on them (`time.perf_counter`)
+        '''
+        self.throughput[stage]['items'] += items
+        self.throughput[stage]['seconds'] += time.perf_counter() - start
+
+    def _send(self, name, *args):
+        '''
+        Internal function to write a command to the server without waiting for it to complete
+
+        Returns:
+            str: the tag of the command
+        '''
+        self.__tag += 1
+        tag = f'{TAG_PREFIX}{self.__tag}'
+        self._write(' '.join((tag, name) + args).encode() + b'\r\n')
+        return tag
+
+    async def _receive(self, pending):
+        '''
+        Internal function to wait for the oldest command that's in flight to complete.
+        The server answers pipelined commands in order so any untagged responses belong
+        to the oldest command that hasn't completed yet
+
+        Args:
+            pending (collections.deque): the commands in flight, oldest first.
+                Each is a list of the name, tag and untagged responses of the command
+
+        Returns:
+            tuple: see `self._command`
+        '''
+        name, tag, untagged = pending[0]
+        while tag not in self.__completed:
+            response_tag, kind, data = await self._read_response()
+            if response_tag == '*':
+                untagged.setdefault(kind, []).extend(data)
+            elif response_tag != '+':
+                self.__completed[response_tag] = (kind, data)
+        pending.popleft()
+
+        kind, data = self.__completed.pop(tag)
+        text = _response_text(data)
+        if kind == 'BAD':
+            raise Exception(f'{name} command failed: {text}')
+        return kind, untagged, text
+
+    async def _command(self, name, *args):
+        '''
+        Internal function to send a command to the server and wait for it to complete
+
+        Args:
+            name (str): the command, eg: 'SELECT'
+            args (tuple): the arguments to the command. Must already be quoted if necessary
+
+        Returns:
+            tuple: the status of the command (eg: 'OK'), the untagged responses sent back
+                (a dict of lists of response data, keyed by type, eg: 'FETCH') and the text
+                of the tagged response
+
+        Raises:
+            Exception: if the server didn't understand the command (a BAD response)
+        '''
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            pending = deque([[name, self._send(name, *args), {}]])
+            await self.writer.drain()
+            return await self._receive(pending)
+
+    async def _pipeline(self, commands, uid=False):
+        '''
+        Internal function to send a group of commands without waiting for each one to complete
+        before sending the next. The commands are sent in rounds of up to `self.window` at once, which
+        hides the latency of the connection when fetching or deleting lots of batches.
+        The connection is only locked while a round is in flight, so whoever is using the results
+        can send other commands in between rounds
+
+        Args:
+            commands (iterable): tuples of the command name and its arguments. Only
+                commands that don't depend on each other (eg: FETCH and STORE) should be pipelined
+            uid (bool): use the UID variant of each command if `self.uid` is set
+
+        Returns:
+            async generator: yields the result of each command (see `self._command`) in order
+        '''
+        prefix = ('UID',) if uid and self.uid else ()
+        commands = iter(commands)
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        while True:
+            results = []
+            async with self.__lock:
+                pending = deque(
+                    [command[0], self._send(*command), {}]
+                    for command in (prefix + tuple(i) for i in islice(commands, self.window))
+                )
+                if not pending:
+                    return
+                try:
+                    await self.writer.drain()
+                    while pending:
+                        results.append(await self._receive(pending))
+                finally:
+                    # wait for anything still in flight so the next command doesn't get its responses
+                    while pending:
+                        await self._receive(pending)
+            for result in results:
+                yield result
+
+    async def _uid_command(self, name, *args):
+        '''
+        Internal function to run a command (see `self._command`), using the UID
+        variant of the command if `self.uid` is set
+        '''
+        if self.uid:
+            return await self._command('UID', name, *args)
+        return await self._command(name, *args)
+
+    async def login(self, username, password):
+        '''
+        Logs a user into the server.
+        If the server supports them, CONDSTORE (or QRESYNC) is then enabled so that labels
+        report their HIGHESTMODSEQ (see `self.select_label`) and the connection is compressed
+        (see `self.start_compression`)
 
         Args:
             username (str): the email to log in as
             password (str): the password to log in with
         '''
-        self.server.login(username, password)
+        status, _, text = await self._command('LOGIN', _quote(username), _quote(password))
+        if status != 'OK':
+            raise Exception(text)
         self.logged_in = True
+        # the server can advertise more once we've logged in
+        codes = response_codes([text.encode()])
+        self.capabilities = set(codes['CAPABILITY'].upper().split()) if 'CAPABILITY' in codes else None
 
-    def select_label(self, label='inbox'):
+        capabilities = await self.get_capabilities()
+        if 'ENABLE' in capabilities:
+            # QRESYNC includes CONDSTORE
+            for extension in ('QRESYNC', 'CONDSTORE'):
+                if extension in capabilities:
+                    await self.enable(extension)
+                    break
+        if self.compress and 'COMPRESS=DEFLATE' in capabilities:
+            await self.start_compression()
+
+    async def start_compression(self):
         '''
-        Select folder to search from
+        Compresses everything sent and received from now on with DEFLATE (RFC 4978).
+        Headers and bodies are mostly text so FETCH responses shrink a lot.
+        See `self.traffic` for how much was saved
+
+        Returns:
+            bool: whether the server agreed to compress the connection
+        '''
+        if self.__deflate is not None:
+            return True
+        status, _, _ = await self._command('COMPRESS', 'DEFLATE')
+        if status != 'OK':
+            return False
+        # raw DEFLATE, without the zlib header and checksum
+        self.__deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.__inflate = zlib.decompressobj(-15)
+        # the server compresses everything after its OK, some of which we may have already read
+        if self.__buffer:
+            self.traffic['received'] -= len(self.__buffer)
+            self.__buffer = bytearray(self.__inflate.decompress(bytes(self.__buffer)))
+            self.traffic['received'] += len(self.__buffer)
+        return True
+
+    async def get_capabilities(self):
+        '''
+        Gets the capabilities of the server. These are only requested once
+
+        Returns:
+            set: the capabilities (eg: 'IDLE', 'CONDSTORE'), in upper case
+        '''
+        if self.capabilities is None:
+            _, untagged, _ = await self._command('CAPABILITY')
+            self.capabilities = set()
+            for line in untagged.get('CAPABILITY', []):
+                self.capabilities.update(line.decode().upper().split())
+        return self.capabilities
+
+    async def enable(self, *extensions):
+        '''
+        Enables extensions on the server (RFC 5161)
+
+        Args:
+            extensions (tuple): the extensions to enable (eg: 'CONDSTORE')
+
+        Returns:
+            set: every extension that is now enabled
+        '''
+        status, untagged, _ = await self._command('ENABLE', *extensions)
+        if status == 'OK':
+            for line in untagged.get('ENABLED', []):
+                self.enabled.update(line.decode().upper().split())
+        return self.enabled
+
+    @property
+    def condstore(self):
+        '''
+        Whether the server keeps track of mod-sequences for us (RFC 7162)
+        '''
+        return 'CONDSTORE' in self.enabled or 'QRESYNC' in self.enabled
+
+    async def select_label(self, label='inbox'):
+        '''
+        Select folder to search from.
+        The UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ (if CONDSTORE is enabled) of the label are stored in
+        `self.uidvalidity`, `self.uidnext` and `self.highestmodseq`
 
         Args:
             label (str): the label to select
         '''
-        out = self.server.select(label)
-        if out[0] == 'OK':
-            return
+        # labels can have spaces in them (eg: [Gmail]/All Mail) so they need quoting
+        status, untagged, text = await self._command('SELECT', _quote(label))
+        if status != 'OK':
+            all_labels = await self.get_labels()
+            for k in all_labels.keys():
+                if k.lower() == label.lower():
+                    status, untagged, text = await self._command('SELECT', _quote(all_labels[k]))
+                    if status == 'OK':
+                        label = all_labels[k]
+                        break
 
-        all_labels = self.get_labels()
-        for k in all_labels.keys():
-            if k.lower() == label.lower():
-                out = self.server.select(all_labels[k])
-                if out[0] == 'OK':
-                    return
+        if status != 'OK':
+            self.label = self.uidvalidity = self.uidnext = self.highestmodseq = None
+            raise Exception(text)
 
-        raise Exception(out[1].decode())
+        codes = response_codes(untagged.get('OK', []))
+        self.label = label
+        self.uidvalidity = int(codes['UIDVALIDITY']) if 'UIDVALIDITY' in codes else None
+        self.uidnext = int(codes['UIDNEXT']) if 'UIDNEXT' in codes else None
+        self.highestmodseq = int(codes['HIGHESTMODSEQ']) if 'HIGHESTMODSEQ' in codes else None
 
-    def get_labels(self):
+    async def status(self, label, *items):
         '''
-        Gets all the available labels in this users email account
+        Gets the status of a label without selecting it
+
+        Args:
+            label (str): the label
+            items (tuple): the status items to get (eg: 'UIDNEXT', 'HIGHESTMODSEQ')
+
+        Returns:
+            dict: the value (int) of each item, keyed by item
+        '''
+        status, untagged, text = await self._command('STATUS', _quote(label), f'({" ".join(items)})')
+        if status != 'OK':
+            raise Exception(text)
+        result = {}
+        for line in untagged.get('STATUS', []):
+            # label names sent as literals come before the values
+            if type(line) == tuple or b'(' not in line:
+                continue
+            values = line[line.rindex(b'(') + 1:line.rindex(b')')].decode().split()
+            result.update((k.upper(), int(v)) for k, v in zip(values[::2], values[1::2]))
+        return result
+
+    async def _esearch(self, criteria):
+        '''
+        Internal function to run a SEARCH command (see `self._uid_command`) and get the results
+        as ranges of IDs rather than one ID per email.
+        If the server supports ESEARCH (RFC 4731) then it sends the results as ranges, so a search
+        that matches hundreds of thousands of emails is only a few hundred bytes. Otherwise the
+        results are compacted into ranges as they're read
+
+        Returns:
+            dict: 'ALL' is the matching email IDs (IDSet), 'COUNT' is the number of matches and
+                'MIN' and 'MAX' are the lowest and highest matching IDs (None if nothing matched)
+        '''
+        if 'ESEARCH' in await self.get_capabilities():
+            _, untagged, _ = await self._uid_command('SEARCH', 'RETURN (ALL COUNT MIN MAX)', criteria)
+            return parse_esearch_response(untagged.get('ESEARCH', []))
+
+        _, untagged, _ = await self._uid_command('SEARCH', criteria)
+        ids = IDSet(i for line in untagged.get('SEARCH', []) for i in line.split())
+        return {
+            'ALL': ids,
+            'COUNT': len(ids),
+            'MIN': ids.min() if ids else None,
+            'MAX': ids.max() if ids else None
+        }
+
+    async def _search(self, criteria):
+        '''
+        Internal function to run a SEARCH command (see `self._esearch`)
+
+        Returns:
+            IDSet: the matching email IDs
+        '''
+        return (await self._esearch(criteria))['ALL']
+
+    async def get_labels(self):
+        '''
+        Gets all the available labels in this users email account.
+        Labels with a special use (RFC 6154) are also stored in `self.special_labels`,
+        keyed by their use (eg: '\\All' or '\\Trash')
 
         Returns:
             dict: keys are the "name" of the label (eg: Starred)
@@ -74,10 +497,18 @@ class Server():
         if self.labels is not None:
             return self.labels
         else:
-            raw = self.server.list()[1]
+            _, untagged, _ = await self._command('LIST', '""', '*')
             labels = {}
-            for r in raw:
+            special_labels = {}
+            for r in untagged.get('LIST', []):
+                if type(r) != bytes or r == b'':
+                    continue
                 v = r.decode().replace('"', '').split('/', 1)[1].lstrip(' ')
+                attributes = r.decode()
+                attributes = attributes[attributes.index('(') + 1:attributes.index(')')].split()
+                for attribute in attributes:
+                    if attribute.lower() in SPECIAL_USES:
+                        special_labels[SPECIAL_USES[attribute.lower()]] = v
                 if v == '[Gmail]':
                     continue
                 if v.startswith('[Gmail]/'):
@@ -86,15 +517,79 @@ class Server():
                     k = v
                 labels[k] = v
             self.labels = labels
+            self.special_labels = special_labels
         return labels
 
-    def search(self, query, from_=False, cc=False, bcc=False, subject=False, body=False, all_match=True, exact_match=True, sub_filters=[], **kwargs):
+    async def idle(self, timeout=None):
+        '''
+        Waits for the server to tell us about new emails in the selected label (RFC 2177)
+
+        Args:
+            timeout (int): the max number of seconds to wait. Servers drop connections that have been
+                idle for 30 minutes so this should be less than that. Defaults to `IDLE_TIMEOUT`
+
+        Returns:
+            dict: the untagged responses the server sent while idling (eg: 'EXISTS'), keyed by type.
+                Empty if the timeout was reached
+        '''
+        if timeout is None:
+            timeout = IDLE_TIMEOUT
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            pending = deque([['IDLE', self._send('IDLE'), {}]])
+            await self.writer.drain()
+            response_tag, kind, data = await self._read_response()
+            if response_tag != '+':
+                # the server refused to idle
+                self.__completed[response_tag] = (kind, data)
+                status, _, text = await self._receive(pending)
+                raise Exception(f'IDLE command failed: {text}')
+
+            done = False
+
+            def finish():
+                nonlocal done
+                if not done:
+                    done = True
+                    self._write(b'DONE\r\n')
+
+            # stop idling once the timeout is up or as soon as we hear about any new emails
+            timer = asyncio.get_running_loop().call_later(timeout, finish)
+            untagged = pending[0][2]
+            try:
+                while True:
+                    response_tag, kind, data = await self._read_response()
+                    if response_tag == '*':
+                        untagged.setdefault(kind, []).extend(data)
+                        if kind in ('EXISTS', 'RECENT'):
+                            finish()
+                    elif response_tag != '+':
+                        # the server has stopped idling so there's no need to tell it to stop
+                        done = True
+                        self.__completed[response_tag] = (kind, data)
+                        break
+            finally:
+                timer.cancel()
+                # if we're interrupted the server has to be told to stop idling before any more commands are sent
+                finish()
+            await self._receive(pending)
+            return untagged
+
+    async def search(
+        self, query, from_=False, cc=False, bcc=False, subject=False, body=False, all_match=True, exact_match=True,
+        sub_filters=[], gmail_raw=False, **kwargs
+    ):
         '''
         Searches the current label for emails matching the query
         If kwargs isn't empty and contains the key 'from' then we override the from_ kwarg with that value.
         If it has the key 'search' then we override query with that
         Mostly just to make it more convenient to dump kwargs into this function via dict unpacking
 
+        The query and all of the sub-filters are compiled into a single search (see `compile_search`)
+        so this only costs one round trip to the server, plus one batched fetch if any
+        exact matching needs to be done
+
         Args:
             query (str): what you are searching for
             from_ (bool): check if the sender of the email matches the query
@@ -107,10 +602,12 @@ class Server():
             sub_filters (list): sub-filters to also match against.
                                 Each must be a dict with keys corresponding to this
                                 function's kwargs
+            gmail_raw (bool): search using Gmail's own search syntax (see `compile_gmail_raw`)
+                instead of standard IMAP search keys
             kwargs (dict): used to override some other kwargs
 
         Returns:
-            list: list of email UIDs
+            IDSet: the email UIDs
 
         Raises:
             Exception: if a valid search query could not be constructed
@@ -121,194 +618,3088 @@ class Server():
             if 'search' in kwargs.keys():
                 query = kwargs['search']
 
-        lookup = []
-        if from_:
-            lookup.append(f'FROM "{query}"')
-        if cc:
-            lookup.append(f'CC "{query}"')
-        if bcc:
-            lookup.append(f'BCC "{query}"')
-        if subject:
-            lookup.append(f'SUBJECT "{query}"')
-        if body:
-            lookup.append(f'BODY "{query}"')
-
-        if lookup == []:
-            raise Exception('Could not create valid search query from your arguments')
+        filter = {
+            'search': query,
+            'from': from_,
+            'cc': cc,
+            'bcc': bcc,
+            'subject': subject,
+            'body': body,
+            'all_match': all_match,
+            'exact_match': exact_match,
+            'sub_filters': sub_filters
+        }
+        if gmail_raw:
+            return await self.search_compiled(compile_gmail_raw(filter), [filter])
+        return await self.search_compiled(compile_search(filter), [filter])
 
-        if all_match:
-            lookup = f'({" ".join(lookup)})'
-            _, result = self.server.search(None, lookup)
-            result = result[0].split()
-        else:
-            result = []
-            for look in lookup:
-                _, tmp = self.server.search(None, look)
-                result += tmp[0].split()
+    async def __candidates(self, criteria):
+        '''
+        Internal function to search for the emails that a search method needs to check
+
+        Returns:
+            IDSet: the UIDs of the emails
+        '''
+        start = time.perf_counter()
+        result = await self._search(criteria)
+        self._record('search', len(result), start)
+        return result
+
+    async def __claim(self, matches, handled):
+        '''
+        Internal function to mark the matches of a search as dealt with (see `self.search_compiled`).
+        Only the Gmail message IDs of the matches are fetched, and they're streamed in as they arrive
+        rather than held for the whole label
+
+        Returns:
+            IDSet: the matches that haven't been dealt with in another label
+        '''
+        if handled is None or not matches or 'X-GM-EXT-1' not in await self.get_capabilities():
+            return matches
+        claimed = []
+        seen = []
+        async for uid, message_id in _stage(self._fetch_items(matches, 'X-GM-MSGID'), self._record, 'fetch'):
+            seen.append(uid)
+            # checking and claiming happen without awaiting in between, so two labels can't both claim an email
+            if message_id not in handled:
+                handled.add(message_id)
+                claimed.append(uid)
+        # emails without a message ID can't be in another label
+        return IDSet(claimed) | (matches - IDSet(seen))
+
+    async def search_compiled(self, criteria, filters, handled=None):
+        '''
+        Runs a compiled search and then checks the results against the exact matching rules of
+        the filters. Every filter must compile to `criteria` so that they can share the one search
+
+        Args:
+            criteria (str): the search, as returned by `compile_search` or `compile_gmail_raw`
+            filters (list): the filters (as produced by `validate_filter`) that compile to `criteria`
+            handled (set): the Gmail message IDs (see `self.get_message_ids`) of emails that have already
+                been dealt with in other labels. Matches in the set are left out, and the IDs of any new matches
+                are added to it. Ignored if the server doesn't support Gmail's extensions
+
+        Returns:
+            IDSet: the UIDs of emails that match any of the filters
+        '''
+        result = await self.__candidates(criteria)
 
-        if sub_filters == []:
-            full_result = result
+        # the server can only check if a field contains the query so anything that needs to
+        # match exactly (or is a regular expression) has to be checked locally
+        exact = []
+        for filter in filters:
+            parts = _exact_parts(filter)
+            if parts == []:
+                # this filter doesn't need exact matching so it takes every result
+                exact = None
+                break
+            exact.append(parts)
+
+        if exact is None or not result:
+            matches = result
         else:
-            full_result = []
-            sub_searches = []
-            for sub in sub_filters:
-                sub_searches.append(self.search(query, **sub))
-            for item in result:
-                if all(item in sub for sub in sub_searches):
-                    full_result.append(item)
-
-        if not exact_match:
-            return full_result
-
-        filtered = []
-        emails = self.get_emails_by_id(full_result)
-        for e in emails:
-            for i in ('from_', 'cc', 'bcc', 'subject', 'body'):
-                # this bit here is just grabbing the variables associated with the above strings
-                # which were passed as kwargs and then re-using it as the dict key
-                # just coz I couldn't be bothered to type these 5 variable names twice
-                # or to do a bunch of if/else statements
-                if locals()[i]:
-                    if i == 'from_':
-                        tmp = e[i.replace('_', '')]
-                        if query in (tmp['raw'], tmp['email']):
-                            filtered.append(e['id'])
-                    if query == e[i.replace('_', '')]:
-                        filtered.append(e['id'])
-                        break
+            predicate = Predicate(exact)
+            matches = []
+            # emails are fetched in the background while earlier ones are being checked.
+            # The bodies are only downloaded if we are going to check them
+            fetch = self.fetch(result, body=predicate.body, digest=predicate.digest)
+            async for e in _stage(fetch, self._record, 'fetch'):
+                start = time.perf_counter()
+                if predicate(e):
+                    matches.append(e['id'])
+                self._record('match', 1, start)
+            matches = IDSet(matches)
 
-        return filtered
+        return await self.__claim(matches, handled)
 
-    def get_email_ids(self):
+    async def search_senders(self, blocklist, criteria='ALL', handled=None):
+        '''
+        Checks who sent every email matching a search against a list of blocked senders.
+        Rather than searching for each sender separately, the From header of each email is
+        downloaded once (see `self.senders`) and looked up in the blocklist, so the cost doesn't
+        depend on the number of blocked senders
+
+        Args:
+            blocklist (SenderIndex): the blocked senders
+            criteria (str): the emails to check
+            handled (set): the Gmail message IDs of emails that have already been dealt with in other labels
+                (see `self.search_compiled`)
+
+        Returns:
+            IDSet: the UIDs of emails from blocked senders
+        '''
+        result = await self.__candidates(criteria)
+
+        scoped = any(None not in scopes for scopes in blocklist.values())
+        matches = []
+        async for uid, senders, labels in _stage(self.senders(result, scoped), self._record, 'fetch'):
+            start = time.perf_counter()
+            for sender in senders:
+                scopes = blocklist.get(sender)
+                if scopes is not None and (None in scopes or not scopes.isdisjoint(labels)):
+                    matches.append(uid)
+                    break
+            self._record('match', 1, start)
+        matches = IDSet(matches)
+
+        return await self.__claim(matches, handled)
+
+    async def search_phrases(self, index, criteria='ALL', handled=None):
+        '''
+        Checks the subject and body of every email matching a search for the phrases in an index.
+        Rather than searching for each phrase separately, the emails are downloaded once and each
+        field is scanned for every phrase in one go (see `PhraseIndex`)
+
+        Args:
+            index (PhraseIndex): the rules to check
+            criteria (str): the emails to check
+            handled (set): the Gmail message IDs of emails that have already been dealt with in other labels
+                (see `self.search_compiled`)
+
+        Returns:
+            IDSet: the UIDs of emails that match any of the rules
+        '''
+        result = await self.__candidates(criteria)
+
+        matches = []
+        # the emails that match rules which only apply to some Gmail labels, and those labels
+        scoped = {}
+        async for e in _stage(self.fetch(result, body=index.body), self._record, 'fetch'):
+            start = time.perf_counter()
+            scopes = index.match(e)
+            if None in scopes:
+                matches.append(e['id'])
+            elif scopes:
+                scoped[e['id']] = scopes
+            self._record('match', 1, start)
+
+        if scoped:
+            gmail_labels = await self.get_gmail_labels(IDSet(scoped.keys()))
+            matches.extend(uid for uid, scopes in scoped.items() if not scopes.isdisjoint(gmail_labels.get(uid, ())))
+        return await self.__claim(IDSet(matches), handled)
+
+    async def get_email_ids(self):
         '''
         Get the UID of every single email in the currently selected label
 
         Returns:
-            list: list of email UIDs
+            IDSet: the email UIDs
         '''
-        _, ids = self.server.search(None, 'all')
-        return ids[0].split()
+        return await self._search('ALL')
 
-    def __get_emails_by_id(self, id):
+    async def _fetch_items(self, id, item):
         '''
-        Internal function to gather info about an email.
-        Do not call. Call `self.get_emails_by_id` instead
+        Internal function to fetch a single item (eg: 'X-GM-MSGID') of some emails
+
+        Returns:
+            async generator: yields a tuple of the UID (int) and the value of the item for each email
         '''
-        if type(id) != list:
+        if type(id) not in (list, set, frozenset, tuple, IDSet):
             id = [id]
+        id_key = 'UID' if self.uid else 'SEQ'
+        commands = (('FETCH', id_set, f'(UID {item})') for id_set in sequence_sets(id))
+        async for _, untagged, _ in self._pipeline(commands, uid=True):
+            for response in parse_fetch_response(untagged.get('FETCH', [])):
+                if id_key in response and item in response:
+                    yield response[id_key], response[item]
 
-        for email_id in id:
-            try:
-                data = self.server.fetch(email_id, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)] RFC822)')
-                parser = HeaderParser()
-                head_data = parser.parsestr(data[1][0][1].decode())
-                info = {
-                    'id': email_id,
-                    'from': {
-                        'raw': head_data['from'],
-                        'email': None,
-                        'name': None
-                    },
-                    'to': head_data['to'],
-                    'cc': head_data['cc'],
-                    'bcc': head_data['bcc'],
-                    'date': head_data['date'],
-                    'subject': head_data.get('subject')
-                }
-                if '?utf-8?B?' in info['subject']:
-                    # manually decode this because all email protocols are garbage
-                    try:
-                        subs = []
-                        for i in info['subject'].split(' '):
-                            if i != '':
-                                subs.append(
-                                    base64.b64decode(i.replace('?utf-8?B?', '')).decode()
-                                )
-                        info['subject'] = ''.join(subs)
-                    except Exception:
-                        pass
-                # the "from" of an email is usually returned as "John Smith <johnsmith@gmail.com>"
-                # so let's parse that real quick
-                from_ = info['from']['raw']
-                if email_valid(from_):
-                    info['from']['email'] = from_
-                else:
-                    from_ = from_.split(' ')
-                    if from_[-1].startswith('<') and from_[-1].endswith('>'):
-                        if email_valid(from_[-1][1:-1]):
-                            info['from']['email'] = from_[-1][1:-1]
-                            info['from']['name'] = ' '.join(from_[:-1])
-
-                # the body requires some extra parsing to filter out the junk
-                boundary = head_data.get_boundary()
-                try:
-                    body = head_data.get_payload(decode=True).replace('\r\n', '\n').split('--' + boundary)
-                except TypeError:
-                    body = head_data.get_payload().replace('\r\n', '\n').split('--' + boundary)
-                while '' in body:
-                    body.remove('')
-                plaintext = None
-                for section in body:
-                    section = section.split('\n')
-                    for line in section:
-                        if line.startswith('Content-Type: text/plain;'):
-                            plaintext = '\n'.join(
-                                i for i in section if not i.startswith(
-                                    ('Content-Type: ', 'Content-Transfer-Encoding: ')
-                                )
-                            )
-                            break
-                    if plaintext is not None:
-                        break
-                info['body'] = plaintext
-                yield info
-            except Exception:
-                pass
+    async def _fetch_item(self, id, item):
+        '''
+        Internal function to fetch a single item (eg: 'X-GM-MSGID') of some emails (see `self._fetch_items`)
+
+        Returns:
+            dict: the value of the item for each email, keyed by UID (int)
+        '''
+        return {uid: value async for uid, value in self._fetch_items(id, item)}
 
-    def get_emails_by_id(self, id, generator=False):
+    async def get_message_ids(self, id):
         '''
-        Get info about an email via ID
+        Gets the Gmail message IDs (X-GM-MSGID) of some emails. Unlike UIDs, these are the
+        same in every label that an email is in
 
         Args:
-            id (bytes): can be email UID or list of email UIDs
-            generator (bool): whether to generate these or to return complete list
+            id (int): can be email UID or list/set/IDSet of email UIDs
 
         Returns:
-            list: list of dicts
+            dict: the message ID (int) of each email, keyed by UID (int)
         '''
-        if generator:
-            return self.__get_emails_by_id(id)
-        else:
-            return [i for i in self.__get_emails_by_id(id)]
+        return await self._fetch_item(id, 'X-GM-MSGID')
 
-    def delete_email(self, email_id):
+    async def get_gmail_labels(self, id):
         '''
-        Deletes an email
+        Gets the Gmail labels (X-GM-LABELS) of some emails. System labels are given by their
+        special name (eg: '\\Inbox' or '\\Starred') and everything else by the name of the label
+        (see `gmail_label`)
 
         Args:
-            email_id (bytes): an email UID (same type as returned by `self.get_email_ids`)
+            id (int): can be email UID or list/set/IDSet of email UIDs
+
+        Returns:
+            dict: the labels (set) of each email, keyed by UID (int)
         '''
-        if type(email_id) == dict and 'id' in email_id.keys():
-            email_id = email_id['id']
-        if type(email_id) != bytes:
-            raise TypeError('email must be bytes id')
-        self.server.store(email_id, '+X-GM-LABELS', '\\Trash')
-        self.server.expunge()
+        values = await self._fetch_item(id, 'X-GM-LABELS')
+        return {k: _label_names(v) for k, v in values.items()}
 
-    def __exit__(self, *args, **kwargs):
-        self.close()
+    async def senders(self, id, gmail_labels=False):
+        '''
+        Gets who sent some emails. Only the From header is downloaded
 
-    def close(self):
+        Args:
+            id (IDSet): the email UIDs
+            gmail_labels (bool): whether to also get the Gmail labels of each email (see `self.get_gmail_labels`)
+
+        Returns:
+            async generator: yields a tuple for each email of its UID (int), the address in its From header
+                (a set that is empty if it doesn't have one, see `sender_address`) and its Gmail labels (set,
+                or None if `gmail_labels` isn't set)
         '''
-        Closes the server and logs the user out
+        id_key = 'UID' if self.uid else 'SEQ'
+        items = f'(UID {"X-GM-LABELS " if gmail_labels else ""}BODY.PEEK[HEADER.FIELDS (FROM)])'
+        commands = (
+            ('FETCH', id_set, items) for batch in IDSet(id).chunks(FETCH_BATCH_SIZE) for id_set in sequence_sets(batch)
+        )
+        async for _, untagged, _ in self._pipeline(commands, uid=True):
+            for item in parse_fetch_response(untagged.get('FETCH', [])):
+                header = next((v for k, v in item.items() if k.startswith('BODY[HEADER.FIELDS')), None)
+                if item.get(id_key) is None or header is None:
+                    continue
+                address = sender_address(HeaderParser().parsestr(header.decode(errors='replace'))['from'])
+                yield (
+                    item[id_key],
+                    set() if address is None else {address},
+                    _label_names(item.get('X-GM-LABELS') or []) if gmail_labels else None
+                )
+
+    async def fetch(self, id, batch_size=None, body=False, body_limit=None, digest=False):
         '''
-        if self.logged_in:
-            try:
-                self.server.close()
-            except Exception:
+        Get info about emails via ID.
+        Emails are fetched in batches, with one FETCH command per batch rather than per email,
+        and several batches are requested at once (see `self._pipeline`).
+        Only the headers are downloaded unless `body` is set, in which case only the plain
+        text part of each email is downloaded (never the attachments).
+        If this server has a cache (see `EmailCache`) then emails that are in the cache aren't downloaded
+        again, as long as the bodies aren't needed (or only their digests are)
+
+        Args:
+            id (int): can be email UID or list/set/IDSet of email UIDs
+            batch_size (int): the max number of emails to fetch per command.
+                Defaults to `FETCH_BATCH_SIZE`
+            body (bool): whether to fetch the plain text body of each email.
+                If False then the 'body' of each email is None
+            body_limit (int): the max number of bytes of each body to download
+            digest (bool): whether the 'body_digest' of each email (see `body_digest`) is all that's
+                needed. Emails that come from the cache have a 'body' of None
+
+        Returns:
+            async generator: yields a dict for each email as soon as its batch arrives
+        '''
+        if batch_size is None:
+            batch_size = FETCH_BATCH_SIZE
+        if isinstance(id, IDSet):
+            ids = id
+            requested = {}
+        else:
+            if type(id) not in (list, set, frozenset, tuple):
+                id = [id]
+            # map the numeric ID back to whatever the caller passed in
+            requested = {int(i): i for i in id}
+            ids = IDSet(requested.keys())
+        id_key = 'UID' if self.uid else 'SEQ'
+        # only grab the headers. If we need the body then the BODYSTRUCTURE tells us
+        # which part of the email holds the text so we can avoid downloading any attachments
+        items = '(UID BODY.PEEK[HEADER] BODYSTRUCTURE)' if body else '(UID BODY.PEEK[HEADER])'
+
+        # the cache is keyed by UID so it can only be used when we're addressing emails by UID
+        cache = self.cache if self.uid and self.uidvalidity is not None else None
+        if cache is not None and (digest or not body):
+            cached = cache.get(self.label, self.uidvalidity, ids, body=body)
+            for uid, email in cached.items():
+                email['id'] = requested.get(uid, uid)
+                yield email
+            ids = ids - cached.keys()
+        if body_limit is not None:
+            # a digest of part of the body isn't any use
+            cache = None
+
+        commands = [('FETCH', id_set, items) for batch in ids.chunks(batch_size) for id_set in sequence_sets(batch)]
+        # the batches are pipelined (see `self._pipeline`). When we need the bodies, the headers for
+        # a window's worth of batches are fetched and then the text parts for those batches
+        group_size = max(1, self.window if body else len(commands))
+        limit = '' if body_limit is None else f'<0.{body_limit}>'
+
+        for group in range(0, len(commands), group_size):
+            headers = {}
+            text_parts = {}
+            fetched = []
+            async for _, untagged, _ in self._pipeline(commands[group:group + group_size], uid=True):
+                for item in parse_fetch_response(untagged.get('FETCH', [])):
+                    email_id = requested.get(item.get(id_key), item.get(id_key))
+                    if email_id not in ids or 'BODY[HEADER]' not in item:
+                        # unsolicited FETCH responses (eg: flag updates) can be mixed in
+                        continue
+                    if not body:
+                        try:
+                            fetched.append(parse_email(email_id, item['BODY[HEADER]']))
+                        except Exception:
+                            continue
+                        yield fetched[-1]
+                        continue
+                    headers[email_id] = item['BODY[HEADER]']
+                    part = find_text_part(item.get('BODYSTRUCTURE'))
+                    if part is not None:
+                        text_parts[email_id] = part
+                if cache is not None and fetched:
+                    # cache each batch as it arrives rather than holding on to every email in the label
+                    cache.put(self.label, self.uidvalidity, fetched)
+                    fetched = []
+
+            if body:
+                # emails that share the same structure can have their text fetched in one go
+                sections = {}
+                for email_id, part in text_parts.items():
+                    sections.setdefault(part[0], []).append(int(email_id))
+                body_commands = (
+                    ('FETCH', id_set, f'(UID BODY.PEEK[{section}]{limit})')
+                    for section, section_ids in sections.items()
+                    for id_set in sequence_sets(section_ids)
+                )
+                async for _, untagged, _ in self._pipeline(body_commands, uid=True):
+                    for item in parse_fetch_response(untagged.get('FETCH', [])):
+                        email_id = requested.get(item.get(id_key), item.get(id_key))
+                        if email_id not in headers or email_id not in text_parts:
+                            continue
+                        section, encoding, charset = text_parts[email_id]
+                        response_key = f'BODY[{section}]' if body_limit is None else f'BODY[{section}]<0>'
+                        if response_key not in item:
+                            continue
+                        try:
+                            email = parse_email(
+                                email_id, headers.pop(email_id), decode_part(item[response_key], encoding, charset)
+                            )
+                        except Exception:
+                            continue
+                        if body_limit is None:
+                            email['body_digest'] = body_digest(email['body'])
+                        fetched.append(email)
+                        yield email
+
+                # emails without any plain text still get returned
+                for email_id, header in headers.items():
+                    try:
+                        email = parse_email(email_id, header)
+                    except Exception:
+                        continue
+                    email['body_digest'] = body_digest('')
+                    fetched.append(email)
+                    yield email
+
+            if cache is not None:
+                cache.put(self.label, self.uidvalidity, fetched)
+
+    async def delete(self, email_ids, expunge=True):
+        '''
+        Deletes a group of emails from the currently selected label.
+        The IDs are sent to the server as compact ranges (eg: `101:180,190`) and the commands are
+        pipelined (see `self._pipeline`).
+        If the server supports MOVE (RFC 6851) then the emails are moved straight to the bin.
+        Otherwise they're given the bin's label, marked as deleted and then expunged, using UID EXPUNGE if the server
+        supports UIDPLUS (RFC 4315) so that nothing else in the label gets expunged.
+        Either way the label is only expunged once, after every email has been moved to the bin
+
+        Args:
+            email_ids (IDSet): email UIDs (same type as returned by `self.get_email_ids`)
+            expunge (bool): whether to expunge the label afterwards. If False then the
+                emails are moved to the bin but will stay in the label until the
+                next expunge. Ignored if the server supports MOVE
+
+        Returns:
+            int: the number of emails deleted
+        '''
+        ids = email_ids
+        if not isinstance(ids, IDSet):
+            ids = []
+            for email_id in email_ids:
+                if type(email_id) == dict and 'id' in email_id.keys():
+                    email_id = email_id['id']
+                if type(email_id) not in (bytes, int):
+                    raise TypeError('email must be bytes or int id')
+                ids.append(email_id)
+            ids = IDSet(ids)
+
+        if not ids:
+            return 0
+
+        start = time.perf_counter()
+        capabilities = await self.get_capabilities()
+        await self.get_labels()
+        trash = self.special_labels.get('\\Trash')
+        if self.uid and 'MOVE' in capabilities and trash is not None and self.label != trash:
+            commands = (('MOVE', id_set, _quote(trash)) for id_set in sequence_sets(ids))
+            moved = True
+            async for status, _, _ in self._pipeline(commands, uid=True):
+                moved = moved and status == 'OK'
+            if moved:
+                self._record('trash', len(ids), start)
+                return len(ids)
+
+        # the emails have to be marked as deleted as well for EXPUNGE to remove them from the label
+        commands = (
+            command
+            for id_set in sequence_sets(ids)
+            for command in (
+                ('STORE', id_set, '+X-GM-LABELS', '\\Trash'),
+                ('STORE', id_set, '+FLAGS.SILENT', '(\\Deleted)'),
+            )
+        )
+        async for _ in self._pipeline(commands, uid=True):
+            pass
+        if expunge and self.uid and 'UIDPLUS' in capabilities:
+            commands = (('EXPUNGE', id_set) for id_set in sequence_sets(ids))
+            async for _ in self._pipeline(commands, uid=True):
                 pass
-            self.server.logout()
-        self.logged_in = False
+        elif expunge:
+            await self._command('EXPUNGE')
+        self._record('trash', len(ids), start)
+        return len(ids)
+
+    async def close(self):
+        '''
+        Closes the server and logs the user out.
+        The selected label is left with UNSELECT (RFC 3691) if the server supports it rather than CLOSE,
+        which would expunge any emails marked as deleted
+        '''
+        if self.writer is None:
+            return
+        try:
+            if self.logged_in and self.label is not None and 'UNSELECT' in (self.capabilities or ()):
+                try:
+                    await self._command('UNSELECT')
+                except Exception:
+                    pass
+            await self._command('LOGOUT')
+        except Exception:
+            pass
+        finally:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+            self.logged_in = False
+            self.__deflate = self.__inflate = None
+
+
+class Server():
+    def __init__(
+        self, username=None, password=None, url='imap.gmail.com', uid=False, window=None, cache=None,
+        compress=True, server=None, loop=None
+    ):
+        '''
+        Initialize the server
+        If user and password are specified then `self.login` is called
+
+        This is a blocking wrapper around `AsyncServer`, which runs each call to completion
+        on an event loop that belongs to this server
+
+        Args:
+            username (str): the email to sign in as
+            password (str): the password to sign in with
+            url (str): the url of the email server (only imap.gmail.com is supported)
+            uid (bool): address emails by UID rather than by sequence number (see `AsyncServer`)
+            window (int): the max number of FETCH/STORE commands to have in flight at once (see `AsyncServer`)
+            cache (EmailCache): where to cache the info of fetched emails (see `AsyncServer`)
+            compress (bool): compress the connection if the server supports it (see `AsyncServer`)
+            server (AsyncServer): an already connected server to wrap instead of opening a new connection
+            loop (asyncio.AbstractEventLoop): the event loop `server` runs on. Required if `server` is given
+        '''
+        self.__own_loop = loop is None
+        self.loop = asyncio.new_event_loop() if loop is None else loop
+        if server is None:
+            server = AsyncServer(url, uid=uid, window=window, cache=cache, compress=compress)
+            self._run(server.connect())
+        self.server = server
+        if username is not None and password is not None:
+            self.login(username, password)
+
+    def __enter__(self, username=None, password=None, label='inbox'):
+        if username is not None and password is not None:
+            self.login(username, password)
+            self.select_label(label)
+        return self
+
+    @property
+    def logged_in(self):
+        return self.server.logged_in
+
+    @property
+    def labels(self):
+        return self.server.labels
+
+    @property
+    def special_labels(self):
+        return self.server.special_labels
+
+    @property
+    def uid(self):
+        return self.server.uid
+
+    @property
+    def traffic(self):
+        return self.server.traffic
+
+    @property
+    def throughput(self):
+        return self.server.throughput
+
+    def _run(self, coroutine):
+        '''
+        Internal function to run a coroutine on this server's event loop and return the result
+        '''
+        return self.loop.run_until_complete(coroutine)
+
+    def _iterate(self, generator):
+        '''
+        Internal function to step through an async generator from synchronous code
+        '''
+        try:
+            while True:
+                try:
+                    yield self._run(generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(generator.aclose())
+
+    def login(self, username, password):
+        '''
+        Logs a user into the server
+
+        Args:
+            username (str): the email to log in as
+            password (str): the password to log in with
+        '''
+        self._run(self.server.login(username, password))
+
+    def select_label(self, label='inbox'):
+        '''
+        Select folder to search from
+
+        Args:
+            label (str): the label to select
+        '''
+        self._run(self.server.select_label(label))
+
+    def get_labels(self):
+        '''
+        Gets all the available labels in this users email account
+
+        Returns:
+            dict: keys are the "name" of the label (eg: Starred)
+                values are the label itself (eg: [Gmail]/Starred)
+        '''
+        return self._run(self.server.get_labels())
+
+    def search(self, query, **kwargs):
+        '''
+        Searches the current label for emails matching the query.
+        See `AsyncServer.search` for the arguments
+
+        Returns:
+            IDSet: the email UIDs
+        '''
+        return self._run(self.server.search(query, **kwargs))
+
+    def search_compiled(self, criteria, filters):
+        '''
+        Runs a compiled search and checks the results against the exact matching rules of
+        the filters. See `AsyncServer.search_compiled`
+
+        Returns:
+            IDSet: the UIDs of emails that match any of the filters
+        '''
+        return self._run(self.server.search_compiled(criteria, filters))
+
+    def get_email_ids(self):
+        '''
+        Get the UID of every single email in the currently selected label
+
+        Returns:
+            IDSet: the email UIDs
+        '''
+        return self._run(self.server.get_email_ids())
+
+    def get_emails_by_id(self, id, generator=False, batch_size=None, body=False, body_limit=None):
+        '''
+        Get info about an email via ID. See `AsyncServer.fetch`
+
+        Args:
+            id (int): can be email UID or list/set/IDSet of email UIDs
+            generator (bool): whether to generate these or to return complete list.
+                When generating, each email is yielded as soon as its batch arrives
+            batch_size (int): the max number of emails to fetch per command.
+                Defaults to `FETCH_BATCH_SIZE`
+            body (bool): whether to fetch the plain text body of each email.
+                If False then the 'body' of each email is None
+            body_limit (int): the max number of bytes of each body to download
+
+        Returns:
+            list: list of dicts
+        '''
+        emails = self._iterate(self.server.fetch(id, batch_size=batch_size, body=body, body_limit=body_limit))
+        if generator:
+            return emails
+        else:
+            return [i for i in emails]
+
+    def delete_email(self, email_id):
+        '''
+        Deletes an email
+
+        Args:
+            email_id (int): an email UID (same type as returned by `self.get_email_ids`)
+        '''
+        self.delete_emails([email_id])
+
+    def delete_emails(self, email_ids, expunge=True):
+        '''
+        Deletes a group of emails from the currently selected label. See `AsyncServer.delete`
+
+        Args:
+            email_ids (IDSet): email UIDs (same type as returned by `self.get_email_ids`)
+            expunge (bool): whether to expunge the label afterwards
+
+        Returns:
+            int: the number of emails deleted
+        '''
+        return self._run(self.server.delete(email_ids, expunge=expunge))
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the server and logs the user out
+        '''
+        if self.loop.is_closed():
+            return
+        self._run(self.server.close())
+        if self.__own_loop:
+            self.loop.close()
+
+
+class ExecutionPlan():
+    def __init__(
+        self, filters, labels=None, incremental=False, full_scan_every=None, special_labels=None, all_mail=None
+    ):
+        '''
+        Works out the commands needed to run a group of filters.
+        Filters are grouped by label so that each label only needs to be selected once,
+        and filters that compile to the same search share a single SEARCH command
+
+        Args:
+            filters (list): the filters to run (as produced by `validate_filter`)
+            labels (dict): the labels in the user's account (see `Server.get_labels`).
+                Used to work out when two filters refer to the same label
+            incremental (bool): only search emails that have arrived in each label since the last
+                time this plan was run. Needs a server with a cache (see `EmailCache.get_mark`).
+                A label is searched in full if its filters or UIDVALIDITY have changed since then
+            full_scan_every (int): when running incrementally, search each label in full
+                after this many incremental runs. If None then labels are only searched in full when they have to be
+            special_labels (dict): the labels with special uses (see `AsyncServer.get_labels`).
+                Needed to scan All Mail
+            all_mail (bool): instead of selecting each label, select All Mail once and check which labels
+                the results are in (see `AsyncServer.get_gmail_labels`). Spam and Trash aren't part of All Mail
+                so they are still selected separately. If None then All Mail is scanned when the filters cover
+                at least `ALL_MAIL_MIN_LABELS` labels
+        '''
+        self.filters = filters
+        self.incremental = incremental
+        self.full_scan_every = full_scan_every
+        # the high-water mark of each label (see `EmailCache.set_mark`), saved once the label's emails are deleted
+        self.marks = {}
+        # {label: {search criteria: [filters]}}
+        self.labels = {}
+        # filters that could not be compiled and the reason why
+        self.errors = []
+        for filter in filters:
+            try:
+                criteria = compile_search(filter)
+            except Exception as e:
+                self.errors.append((filter, e))
+                continue
+            label = resolve_label(filter.get('label', 'Inbox'), labels or {})
+            self.labels.setdefault(label, {}).setdefault(criteria, []).append(filter)
+
+        # labels with lots of filters that just block a sender check every email's sender against a blocklist
+        # instead of searching for each one. {label: SenderIndex}
+        self.blocklists = {}
+        for label, searches in self.labels.items():
+            blocked = [c for c, filters in searches.items() if all(_blocked_sender(f) is not None for f in filters)]
+            if len(blocked) < BLOCKLIST_MIN_SENDERS:
+                continue
+            blocklist = self.blocklists.setdefault(label, SenderIndex())
+            for criteria in blocked:
+                for filter in searches.pop(criteria):
+                    blocklist.add(_blocked_sender(filter))
+
+        # likewise, labels with lots of filters that look for a phrase in the subject or body check every
+        # email for all of them at once. {label: PhraseIndex}
+        self.phrases = {}
+        for label, searches in self.labels.items():
+            phrases = [c for c, filters in searches.items() if all(_phrase_rule(f) for f in filters)]
+            if len(phrases) < PHRASE_MIN_RULES:
+                continue
+            index = self.phrases.setdefault(label, PhraseIndex())
+            for criteria in phrases:
+                for filter in searches.pop(criteria):
+                    index.add(filter)
+
+        # the label that is scanned instead of the others, if any
+        self.all_mail = None
+        # labels that don't exist in the account. Only worked out when scanning All Mail, as selecting them fails anyway
+        self.missing = []
+        # {search criteria: {X-GM-LABELS label (None for any): [filters]}}
+        self.scopes = {}
+        special_labels = special_labels or {}
+        if '\\All' not in special_labels:
+            return
+        outside = (special_labels['\\All'], special_labels.get('\\Junk'), special_labels.get('\\Trash'))
+        if all_mail is None:
+            all_mail = len([i for i in self.labels.keys() if i not in outside]) >= ALL_MAIL_MIN_LABELS
+        if not all_mail:
+            return
+
+        self.all_mail = special_labels['\\All']
+        for label in list(self.labels.keys()):
+            if label in outside[1:]:
+                continue
+            if labels and label != 'INBOX' and label not in labels.values():
+                # checking the X-GM-LABELS of each email for a label that doesn't exist would never match anything
+                self.missing.append(label)
+                del self.labels[label]
+                self.blocklists.pop(label, None)
+                self.phrases.pop(label, None)
+                continue
+            scope = None if label == self.all_mail else gmail_label(label, special_labels)
+            for criteria, filters in self.labels.pop(label).items():
+                self.scopes.setdefault(criteria, {}).setdefault(scope, []).extend(filters)
+            for pattern in self.blocklists.pop(label, {}).keys():
+                self.blocklists.setdefault(self.all_mail, SenderIndex()).add(pattern, scope)
+            if label in self.phrases:
+                for filter, _ in self.phrases.pop(label).rules:
+                    self.phrases.setdefault(self.all_mail, PhraseIndex()).add(filter, scope)
+        if self.scopes or self.all_mail in self.blocklists or self.all_mail in self.phrases:
+            self.labels[self.all_mail] = {
+                criteria: [f for filters in scopes.values() for f in filters]
+                for criteria, scopes in self.scopes.items()
+            }
+
+    def round_trips(self):
+        '''
+        Estimates the minimum number of round trips to the server that running this plan will take,
+        not including logging in. Each batch of emails fetched or deleted will add to this
+
+        Returns:
+            int
+        '''
+        count = 0
+        for label, searches in self.labels.items():
+            # SELECT, all the SEARCHes, then STORE + EXPUNGE
+            count += 1 + len(searches) + 2
+            if label in self.blocklists:
+                # SEARCH ALL then FETCH the senders
+                count += 2
+            if label in self.phrases:
+                # SEARCH ALL then FETCH the headers, plus the text parts if any rules check the body
+                count += 3 if self.phrases[label].body else 2
+            if label == self.all_mail:
+                # the Gmail labels of the results
+                count += 1
+            elif len(self.labels) > 1 and self.all_mail is None:
+                # the Gmail message IDs of the results of each search
+                count += len(searches)
+            exact = [f for filters in searches.values() for f in filters if _exact_parts(f)]
+            if exact:
+                count += 1
+                # bodies need an extra fetch for the text part
+                if any(f.get('body') for filter in exact for f in _exact_parts(filter)):
+                    count += 1
+        return count
+
+    def explain(self):
+        '''
+        Describes the commands this plan will send to the server
+
+        Returns:
+            str
+        '''
+        lines = [f'Plan for {len(self.filters)} filter{"s" if len(self.filters) != 1 else ""}:']
+        for label, searches in self.labels.items():
+            lines.append(f'Label "{label}"' + (' (instead of selecting each label)' if label == self.all_mail else ''))
+            lines.append(f'    SELECT {_quote(label)}')
+            body = False
+            exact = False
+            for criteria, filters in searches.items():
+                lines.append(
+                    f'    SEARCH {criteria} (used by {len(filters)} filter{"s" if len(filters) != 1 else ""})'
+                )
+                for filter in filters:
+                    parts = _exact_parts(filter)
+                    exact = exact or parts != []
+                    body = body or any(f.get('body') for f in parts)
+            if label in self.blocklists:
+                blocked = len(self.blocklists[label])
+                lines.append(
+                    f'    SEARCH ALL, FETCH the From header of each email and check it against '
+                    f'{blocked} blocked sender{"s" if blocked != 1 else ""}'
+                )
+            if label in self.phrases:
+                index = self.phrases[label]
+                lines.append(
+                    f'    SEARCH ALL, FETCH the headers{" and bodies" if index.body else ""} of each email and check '
+                    f'them for {len(index)} phrase{"s" if len(index) != 1 else ""}'
+                )
+            if label == self.all_mail:
+                scopes = set(scope for scopes in self.scopes.values() for scope in scopes.keys())
+                lines.append(
+                    f'    FETCH X-GM-LABELS to check which of the {len(scopes)} '
+                    f'label{"s" if len(scopes) != 1 else ""} each email is in'
+                )
+            elif len(self.labels) > 1 and self.all_mail is None:
+                lines.append('    FETCH X-GM-MSGID of the matches to skip emails already dealt with in another label')
+            if exact:
+                lines.append(
+                    f'    FETCH headers{" and bodies" if body else ""} to check exact matches and regular expressions'
+                )
+            lines.append('    UID MOVE to the bin (or STORE +X-GM-LABELS \\Trash +FLAGS \\Deleted, EXPUNGE)')
+        for label in self.missing:
+            lines.append(f'Skipping label "{label}": it does not exist')
+        for filter, error in self.errors:
+            lines.append(f'Skipping filter "{filter.get("search")}": {error}')
+        if self.incremental:
+            lines.append(
+                'Only emails that arrived or changed since the last run are searched (SEARCH MODSEQ <n> ... or '
+                'SEARCH UID <UIDNEXT>:* ...). Labels that have not changed at all are skipped after a STATUS'
+            )
+        lines.append(
+            f'At least {self.round_trips()} round trips '
+            f'(plus one for every {FETCH_BATCH_SIZE} emails fetched)'
+        )
+        return '\n'.join(lines)
+
+    def execute(self, server, commit=True, on_email=None, output=print, error=None):
+        '''
+        Runs the plan. See `self.execute_async`
+
+        Args:
+            server (Server): a logged in server or a `ServerPool`
+
+        Returns:
+            dict: the UIDs (IDSet) of the matching emails in each label
+        '''
+        return server._run(self.execute_async(server.server, commit, on_email, output, error))
+
+    async def execute_async(self, server, commit=True, on_email=None, output=print, error=None):
+        '''
+        Runs the plan. Each label is selected once, searched and then (if `commit` is set)
+        has its matching emails deleted before the next label is selected.
+        If given an `AsyncServerPool` then the labels are processed concurrently, one per connection
+
+        Args:
+            server (AsyncServer): a logged in server or an `AsyncServerPool`
+            commit (bool): whether to delete the emails that are found
+            on_email (callable): if given, the info of each matching email
+                (see `Server.get_emails_by_id`) is fetched and passed to this, along with the label
+            output (callable): called with progress messages
+            error (callable): called with error messages. Defaults to `output`
+
+        Returns:
+            dict: the UIDs (IDSet) of the matching emails in each label
+        '''
+        if error is None:
+            error = output
+        for label in self.missing:
+            error(f'Failed to select label "{label}": it does not exist')
+        for filter, e in self.errors:
+            error(f'Skipping filter "{filter.get("search")}": {e}')
+        # the same email can be in several labels, so keep track of which emails have been dealt with.
+        # All Mail, Spam and Trash never share emails so this isn't needed when scanning All Mail
+        handled = set() if len(self.labels) > 1 and self.all_mail is None else None
+
+        async def execute_label(server, label):
+            if await self.__unchanged(server, label):
+                output(f'Nothing has changed in label "{label}" since the last run')
+                return IDSet()
+            try:
+                await server.select_label(label)
+            except Exception as e:
+                error(f'Failed to select label "{label}": {e}')
+                return None
+
+            changed, since = self.__changes(server, label)
+            email_ids = IDSet()
+            if label == self.all_mail:
+                email_ids = await self.__scan_all_mail(server, changed, since, output)
+            else:
+                for criteria, filters in self.labels[label].items():
+                    terms = ', '.join(f'"{f["search"]}"' for f in filters)
+                    if changed is None:
+                        output(f'Searching for emails that match {terms} in label "{label}"')
+                        email_ids |= await server.search_compiled(criteria, filters, handled)
+                    else:
+                        output(f'Searching for new emails that match {terms} in label "{label}"')
+                        result = await server.search_compiled(f'{changed} {criteria}', filters, handled)
+                        if since is not None:
+                            # "n:*" always includes the newest email, even if its UID is lower than n
+                            result -= IDSet.from_ranges([(0, since - 1)])
+                        email_ids |= result
+                email_ids |= await self.__search_locally(server, label, changed, since, output, handled)
+
+            if on_email is not None and email_ids:
+                async for e in _stage(server.fetch(email_ids), server._record, 'fetch'):
+                    on_email(label, e)
+            if commit and email_ids:
+                output(f'Sending {len(email_ids)} email{"s" if len(email_ids) > 1 else ""} from "{label}" to the bin')
+                await server.delete(email_ids)
+            if commit:
+                self.__save_mark(label)
+            return email_ids
+
+        return await _for_each_label(server, execute_label, list(self.labels.keys()))
+
+    async def __scan_all_mail(self, server, changed, since, output):
+        '''
+        Internal function to search the selected All Mail label for emails that match filters from
+        any of the labels it covers. See `self.__init__`
+
+        Returns:
+            IDSet: the UIDs of the matching emails
+        '''
+        blocked = await self.__search_locally(server, self.all_mail, changed, since, output)
+
+        results = {}
+        for criteria, filters in self.labels[self.all_mail].items():
+            terms = ', '.join(f'"{f["search"]}"' for f in filters)
+            output(f'Searching for emails that match {terms} in label "{self.all_mail}"')
+            result = await server._search(criteria if changed is None else f'{changed} {criteria}')
+            if since is not None:
+                # "n:*" always includes the newest email, even if its UID is lower than n
+                result -= IDSet.from_ranges([(0, since - 1)])
+            results[criteria] = result
+
+        candidates = IDSet()
+        for result in results.values():
+            candidates |= result
+        if not candidates:
+            return blocked
+        output(f'Checking the labels of {len(candidates)} email{"s" if len(candidates) > 1 else ""}')
+        gmail_labels = await server.get_gmail_labels(candidates)
+
+        matches = []
+        # the exact matching rules of the filters, and the indexes of the ones that each email
+        # has to pass if it isn't already a match
+        rules = []
+        exact = {}
+        for criteria, uids in results.items():
+            for scope, filters in self.scopes[criteria].items():
+                everything = False
+                checks = []
+                for filter in filters:
+                    parts = _exact_parts(filter)
+                    if parts == []:
+                        everything = True
+                    else:
+                        checks.append(len(rules))
+                        rules.append(parts)
+                for uid in uids:
+                    if scope is not None and scope not in gmail_labels.get(uid, ()):
+                        continue
+                    if everything:
+                        matches.append(uid)
+                    else:
+                        exact.setdefault(uid, []).extend(checks)
+
+        matches = IDSet(matches)
+        exact = {k: v for k, v in exact.items() if k not in matches}
+        if exact:
+            # only compile the rules that are needed, so bodies are only downloaded if we are going to check them
+            needed = sorted(set(i for checks in exact.values() for i in checks))
+            renumber = {i: n for n, i in enumerate(needed)}
+            exact = {k: [renumber[i] for i in v] for k, v in exact.items()}
+            predicate = Predicate([rules[i] for i in needed])
+            found = []
+            async for e in server.fetch(IDSet(exact.keys()), body=predicate.body, digest=predicate.digest):
+                if predicate(e, exact[e['id']]):
+                    found.append(e['id'])
+            matches |= found
+        return matches | blocked
+
+    async def __search_locally(self, server, label, changed, since, output, handled=None):
+        '''
+        Internal function to check the emails in the selected label against its blocklist and phrases, if it has any.
+        See `AsyncServer.search_senders` and `AsyncServer.search_phrases`
+
+        Returns:
+            IDSet: the UIDs of the matching emails
+        '''
+        criteria = 'ALL' if changed is None else changed
+        result = IDSet()
+        if label in self.blocklists:
+            blocklist = self.blocklists[label]
+            output(
+                f'Checking {"new " if changed is not None else ""}emails against {len(blocklist)} '
+                f'blocked sender{"s" if len(blocklist) != 1 else ""} in label "{label}"'
+            )
+            result |= await server.search_senders(blocklist, criteria, handled)
+        if label in self.phrases:
+            index = self.phrases[label]
+            output(
+                f'Checking {"new " if changed is not None else ""}emails for {len(index)} '
+                f'phrase{"s" if len(index) != 1 else ""} in label "{label}"'
+            )
+            result |= await server.search_phrases(index, criteria, handled)
+        if since is not None:
+            # "n:*" always includes the newest email, even if its UID is lower than n
+            result -= IDSet.from_ranges([(0, since - 1)])
+        return result
+
+    def __rules(self, label):
+        '''
+        Internal function to get a digest of the filters used on a label, so that we can tell when they change
+        '''
+        blocklist = sorted((k, sorted(v, key=str)) for k, v in self.blocklists.get(label, {}).items())
+        phrases = self.phrases[label].rules if label in self.phrases else []
+        rules = [self.labels[label], blocklist, phrases] if blocklist or phrases else self.labels[label]
+        return hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+
+    async def __unchanged(self, server, label):
+        '''
+        Internal function to check whether anything in a label has changed since the last incremental run.
+        Uses STATUS so the label doesn't need to be selected. Only possible if CONDSTORE is enabled
+        '''
+        if not self.incremental or server.cache is None or not server.condstore:
+            return False
+        mark = server.cache.get_mark(label)
+        if mark is None or mark['highestmodseq'] is None or mark['rules'] != self.__rules(label):
+            return False
+        if self.full_scan_every is not None and mark['runs'] >= self.full_scan_every:
+            return False
+        try:
+            status = await server.status(label, 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ')
+        except Exception:
+            return False
+        return all(status.get(k.upper()) == mark[k] for k in ('uidvalidity', 'uidnext', 'highestmodseq'))
+
+    def __changes(self, server, label):
+        '''
+        Internal function to work out which emails in the selected label need searching when running incrementally.
+        Also makes a note of the label's high-water mark for `self.__save_mark`
+
+        Returns:
+            tuple: the search key that matches the emails (eg: 'MODSEQ 1234' or 'UID 100:*')
+                and the UID the emails start at. Both are None if the whole label needs searching
+        '''
+        if not self.incremental or server.cache is None or not server.uid or server.uidnext is None:
+            return None, None
+        rules = self.__rules(label)
+        mark = server.cache.get_mark(label)
+        changed = since = None
+        runs = 0
+        if mark is not None and mark['uidvalidity'] == server.uidvalidity and mark['rules'] == rules:
+            if self.full_scan_every is None or mark['runs'] < self.full_scan_every:
+                runs = mark['runs'] + 1
+                if mark['highestmodseq'] is not None and server.highestmodseq is not None:
+                    # new emails and any emails that have changed since the last run
+                    changed = f'MODSEQ {mark["highestmodseq"] + 1}'
+                else:
+                    changed = f'UID {mark["uidnext"]}:*'
+                    since = mark['uidnext']
+        self.marks[label] = (
+            server.cache, (server.uidvalidity, server.uidnext, server.highestmodseq, rules, runs)
+        )
+        return changed, since
+
+    def __save_mark(self, label):
+        '''
+        Internal function to save the high-water mark of a label once its emails have been dealt with
+        '''
+        if label in self.marks:
+            cache, mark = self.marks.pop(label)
+            cache.set_mark(label, *mark)
+
+    def commit(self, server, results, output=print, error=None):
+        '''
+        Deletes the emails found by a previous call to `self.execute`. See `self.commit_async`
+
+        Args:
+            server (Server): a logged in server or a `ServerPool`
+        '''
+        server._run(self.commit_async(server.server, results, output, error))
+
+    async def commit_async(self, server, results, output=print, error=None):
+        '''
+        Deletes the emails found by a previous call to `self.execute_async`
+
+        Args:
+            server (AsyncServer): a logged in server or an `AsyncServerPool`
+            results (dict): the return value of `self.execute_async`
+            output (callable): called with progress messages
+            error (callable): called with error messages. Defaults to `output`
+        '''
+        if error is None:
+            error = output
+
+        async def commit_label(server, label):
+            email_ids = results[label]
+            try:
+                await server.select_label(label)
+            except Exception as e:
+                error(f'Failed to select label "{label}": {e}')
+                return None
+            output(f'Sending {len(email_ids)} email{"s" if len(email_ids) > 1 else ""} from "{label}" to the bin')
+            await server.delete(email_ids)
+            self.__save_mark(label)
+            return email_ids
+
+        await _for_each_label(server, commit_label, [label for label, email_ids in results.items() if email_ids])
+        # labels that had nothing to delete are done with as well
+        for label in list(self.marks.keys()):
+            if not results.get(label):
+                self.__save_mark(label)
+
+    def watch(self, server, output=print, error=None):
+        '''
+        Watches for new emails and deletes any that match the plan. See `self.watch_async`.
+        This only returns if every label fails to be watched
+
+        Args:
+            server (ServerPool): the pool of connections to use
+        '''
+        watching = server.loop.create_task(self.watch_async(server.server, output, error))
+        try:
+            server._run(watching)
+        finally:
+            # stop watching (eg: after a KeyboardInterrupt) so that every connection gets closed
+            watching.cancel()
+            try:
+                server._run(watching)
+            except BaseException:
+                pass
+
+    async def watch_async(self, server, output=print, error=None):
+        '''
+        Watches for new emails and deletes any that match the plan.
+        Each label gets its own connection which is IDLEd on (see `AsyncServer.idle`), and only the
+        emails that have arrived since the watch started are searched. Dropped connections are
+        re-opened with an increasing delay between each attempt
+
+        Args:
+            server (AsyncServerPool): the pool of connections to use. Any connections in the pool are
+                closed first because each label needs a connection of its own
+            output (callable): called with progress messages
+            error (callable): called with error messages. Defaults to `output`
+        '''
+        if error is None:
+            error = output
+        labels = list(self.labels.keys())
+        if len(labels) > MAX_CONNECTIONS:
+            error(f'Only the first {MAX_CONNECTIONS} of {len(labels)} labels can be watched at once')
+            labels = labels[:MAX_CONNECTIONS]
+        await server.close()
+        await asyncio.gather(*(self.__watch_label(server, label, output, error) for label in labels))
+
+    async def __watch_label(self, pool, label, output, error):
+        '''
+        Internal function to watch a single label. See `self.watch_async`
+        '''
+        delay = RECONNECT_DELAY
+        since = None
+        while True:
+            server = None
+            try:
+                server = await pool.connect()
+                await server.select_label(label)
+                if not server.uid or server.uidnext is None:
+                    error(f'Cannot watch label "{label}": the server does not support UIDs')
+                    return
+                if since is None:
+                    since = server.uidnext
+                delay = RECONNECT_DELAY
+                output(f'Watching label "{label}" for new emails')
+
+                while True:
+                    await server.idle()
+                    # "n:*" always includes the newest email, even if its UID is lower than n
+                    new = await server._search(f'UID {since}:*') - IDSet.from_ranges([(0, since - 1)])
+                    if not new:
+                        continue
+                    changed = f'UID {since}:{new.max()}'
+                    since = new.max() + 1
+
+                    if label == self.all_mail:
+                        email_ids = await self.__scan_all_mail(server, changed, None, output)
+                    else:
+                        email_ids = IDSet()
+                        for criteria, filters in self.labels[label].items():
+                            email_ids |= await server.search_compiled(f'{changed} {criteria}', filters)
+                        email_ids |= await self.__search_locally(server, label, changed, None, output)
+                    if email_ids:
+                        output(
+                            f'Sending {len(email_ids)} new email{"s" if len(email_ids) > 1 else ""} '
+                            f'from "{label}" to the bin'
+                        )
+                        await server.delete(email_ids)
+            except Exception as e:
+                error(f'Lost connection while watching label "{label}": {e}. Reconnecting in {delay}s')
+            finally:
+                if server is not None:
+                    try:
+                        await server.close()
+                    except Exception:
+                        pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+class AsyncServerPool():
+    def __init__(self, username, password, max_connections=1, **kwargs):
+        '''
+        A pool of logged in connections to the server, so that different labels can be
+        worked on at the same time. Connections are only opened and logged into when they're
+        first needed and are then re-used. Every connection runs on the same event loop
+
+        Args:
+            username (str): the email to sign in as
+            password (str): the password to sign in with
+            max_connections (int): the max number of connections to open at once.
+                Capped at `MAX_CONNECTIONS`
+            kwargs (dict): passed to `AsyncServer` when opening each connection
+        '''
+        self.username = username
+        self.password = password
+        self.max_connections = max(1, min(max_connections, MAX_CONNECTIONS))
+        self.kwargs = kwargs
+        self.servers = []
+        # created on first use so that it belongs to whichever loop the pool runs on
+        self.__idle = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.close()
+
+    @property
+    def traffic(self):
+        '''
+        The number of bytes sent and received by every connection in the pool (see `AsyncServer.traffic`)
+        '''
+        traffic = dict.fromkeys(('sent', 'sent_wire', 'received', 'received_wire'), 0)
+        for server in self.servers:
+            if server is not None:
+                for k in traffic.keys():
+                    traffic[k] += server.traffic[k]
+        return traffic
+
+    @property
+    def throughput(self):
+        '''
+        The throughput of each search stage across every connection in the pool (see `AsyncServer.throughput`)
+        '''
+        throughput = {stage: {'items': 0, 'seconds': 0} for stage in PIPELINE_STAGES}
+        for server in self.servers:
+            if server is not None:
+                for stage, stats in server.throughput.items():
+                    throughput[stage]['items'] += stats['items']
+                    throughput[stage]['seconds'] += stats['seconds']
+        return throughput
+
+    async def acquire(self):
+        '''
+        Gets a logged in connection from the pool, opening a new one if none are free
+        and the pool isn't full. Otherwise it waits for one to be released
+
+        Returns:
+            AsyncServer
+        '''
+        if self.__idle is None:
+            self.__idle = asyncio.Queue()
+        if not self.__idle.empty() or len(self.servers) >= self.max_connections:
+            return await self.__idle.get()
+
+        # claim the slot before connecting so that other tasks don't open too many connections
+        self.servers.append(None)
+        try:
+            server = await self.connect()
+        finally:
+            self.servers.remove(None)
+        self.servers.append(server)
+        return server
+
+    async def connect(self):
+        '''
+        Opens a new logged in connection that isn't part of the pool.
+        The caller is responsible for closing it
+
+        Returns:
+            AsyncServer
+        '''
+        server = AsyncServer(**self.kwargs)
+        try:
+            await server.connect()
+            await server.login(self.username, self.password)
+        except Exception:
+            await server.close()
+            raise
+        return server
+
+    def release(self, server):
+        '''
+        Puts a connection acquired with `self.acquire` back into the pool
+
+        Args:
+            server (AsyncServer): the connection
+        '''
+        self.__idle.put_nowait(server)
+
+    @asynccontextmanager
+    async def session(self):
+        '''
+        Async context manager that acquires a connection and releases it afterwards
+
+        Usage:
+            ```
+            async with pool.session() as server:
+                await server.select_label('Inbox')
+            ```
+        '''
+        server = await self.acquire()
+        try:
+            yield server
+        finally:
+            self.release(server)
+
+    async def close(self):
+        '''
+        Closes every connection in the pool
+        '''
+        servers, self.servers = [i for i in self.servers if i is not None], []
+        self.__idle = None
+        for server in servers:
+            try:
+                await server.close()
+            except Exception:
+                pass
+
+
+class ServerPool():
+    def __init__(self, username, password, max_connections=1, **kwargs):
+        '''
+        A blocking wrapper around `AsyncServerPool`. The connections in the pool all
+        share one event loop, which belongs to this pool
+
+        Args:
+            username (str): the email to sign in as
+            password (str): the password to sign in with
+            max_connections (int): the max number of connections to open at once.
+                Capped at `MAX_CONNECTIONS`
+            kwargs (dict): passed to `AsyncServer` when opening each connection
+        '''
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncServerPool(username, password, max_connections, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    @property
+    def max_connections(self):
+        return self.server.max_connections
+
+    @property
+    def traffic(self):
+        return self.server.traffic
+
+    @property
+    def throughput(self):
+        return self.server.throughput
+
+    def _run(self, coroutine):
+        '''
+        Internal function to run a coroutine on this pool's event loop and return the result
+        '''
+        return self.loop.run_until_complete(coroutine)
+
+    @contextmanager
+    def session(self):
+        '''
+        Context manager that acquires a connection and releases it afterwards
+
+        Usage:
+            ```
+            with pool.session() as server:
+                server.select_label('Inbox')
+            ```
+        '''
+        server = self._run(self.server.acquire())
+        try:
+            yield Server(server=server, loop=self.loop)
+        finally:
+            self.server.release(server)
+
+    def close(self):
+        '''
+        Closes every connection in the pool
+        '''
+        if self.loop.is_closed():
+            return
+        self._run(self.server.close())
+        self.loop.close()
+
+
+class EmailCache():
+    def __init__(self, path, max_entries=None):
+        '''
+        An on-disk cache of parsed emails (see `parse_email`) so that emails that have
+        been seen before don't need to be downloaded again.
+        Emails are keyed by label, UIDVALIDITY and UID. A UID always refers to the same email
+        for as long as the UIDVALIDITY of the label doesn't change.
+        Bodies are not stored, only a digest of them (see `body_digest`), which is enough to
+        check whether a body exactly matches a filter.
+        The high-water mark of each label is also kept here (see `self.set_mark`)
+
+        Args:
+            path (str): the path of the SQLite database to store the cache in
+            max_entries (int): the max number of emails to keep. Once there are more than this
+                the least recently used are removed. Defaults to `CACHE_MAX_ENTRIES`
+        '''
+        self.path = path
+        self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS emails ('
+            'label TEXT, uidvalidity INTEGER, uid INTEGER, from_raw TEXT, from_email TEXT, from_name TEXT, '
+            '"to" TEXT, cc TEXT, bcc TEXT, date TEXT, subject TEXT, body_digest TEXT, used INTEGER, '
+            'PRIMARY KEY (label, uidvalidity, uid))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS marks ('
+            'label TEXT PRIMARY KEY, uidvalidity INTEGER, uidnext INTEGER, highestmodseq INTEGER, rules TEXT, '
+            'runs INTEGER)'
+        )
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < CACHE_VERSION:
+            # emails cached by older versions were parsed differently (eg: their headers weren't decoded)
+            self.db.execute('DELETE FROM emails')
+            self.db.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.db.commit()
+        # incremented every time the cache is used so that the least recently used emails can be evicted
+        self.__used = self.db.execute('SELECT MAX(used) FROM emails').fetchone()[0] or 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def get(self, label, uidvalidity, uids, body=False):
+        '''
+        Gets the cached info of some emails
+
+        Args:
+            label (str): the label the emails are in
+            uidvalidity (int): the UIDVALIDITY of the label
+            uids (IDSet): the UIDs of the emails
+            body (bool): only return emails that have a cached body digest
+
+        Returns:
+            dict: the info of each email that was in the cache (in the same format as `parse_email`), keyed by UID
+        '''
+        found = {}
+        # stay well below SQLite's limit on the number of parameters per query
+        for batch in IDSet(uids).chunks(500):
+            batch = list(batch)
+            rows = self.db.execute(
+                'SELECT uid, from_raw, from_email, from_name, "to", cc, bcc, date, subject, body_digest '
+                f'FROM emails WHERE label=? AND uidvalidity=? AND uid IN ({",".join("?" * len(batch))})',
+                [label, uidvalidity] + batch
+            )
+            for uid, from_raw, from_email, from_name, to, cc, bcc, date, subject, digest in rows:
+                if body and digest is None:
+                    continue
+                found[uid] = {
+                    'id': uid,
+                    'from': {
+                        'raw': from_raw,
+                        'email': from_email,
+                        'name': from_name,
+                        'address': None if from_email is None else normalize_address(from_email)
+                    },
+                    'to': to,
+                    'cc': cc,
+                    'bcc': bcc,
+                    'date': date,
+                    'subject': subject,
+                    'body': None,
+                    'body_digest': digest
+                }
+        if found:
+            self.__used += 1
+            self.db.executemany(
+                'UPDATE emails SET used=? WHERE label=? AND uidvalidity=? AND uid=?',
+                [(self.__used, label, uidvalidity, uid) for uid in found.keys()]
+            )
+            self.db.commit()
+        return found
+
+    def put(self, label, uidvalidity, emails):
+        '''
+        Adds emails to the cache. Any emails in the label with a different UIDVALIDITY are removed
+
+        Args:
+            label (str): the label the emails are in
+            uidvalidity (int): the UIDVALIDITY of the label
+            emails (list): the info of each email, as returned by `parse_email`.
+                The 'id' of each must be its UID
+        '''
+        if not emails:
+            return
+        self.__used += 1
+        self.db.execute('DELETE FROM emails WHERE label=? AND uidvalidity!=?', (label, uidvalidity))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (
+                    label, uidvalidity, int(e['id']), e['from']['raw'], e['from']['email'], e['from']['name'],
+                    e['to'], e['cc'], e['bcc'], e['date'], e['subject'], e.get('body_digest'), self.__used
+                )
+                for e in emails
+            ]
+        )
+        self.evict()
+        self.db.commit()
+
+    def get_mark(self, label):
+        '''
+        Gets the high-water mark of a label, as saved by `self.set_mark`
+
+        Args:
+            label (str): the label
+
+        Returns:
+            dict: with the keys 'uidvalidity', 'uidnext', 'highestmodseq', 'rules' and 'runs'.
+                None if the label has no mark
+        '''
+        row = self.db.execute(
+            'SELECT uidvalidity, uidnext, highestmodseq, rules, runs FROM marks WHERE label=?', (label,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('uidvalidity', 'uidnext', 'highestmodseq', 'rules', 'runs'), row))
+
+    def set_mark(self, label, uidvalidity, uidnext, highestmodseq, rules, runs=0):
+        '''
+        Saves the high-water mark of a label after it has been searched, so that the next search
+        only has to look at emails with a UID of at least `uidnext`, or that have changed since `highestmodseq`
+
+        Args:
+            label (str): the label
+            uidvalidity (int): the UIDVALIDITY of the label when it was searched
+            uidnext (int): the UIDNEXT of the label when it was searched
+            highestmodseq (int): the HIGHESTMODSEQ of the label when it was searched. None if
+                the server doesn't support CONDSTORE
+            rules (str): a digest of the filters that were used to search the label
+            runs (int): the number of incremental searches since the label was last searched in full
+        '''
+        self.db.execute(
+            'INSERT OR REPLACE INTO marks VALUES (?, ?, ?, ?, ?, ?)',
+            (label, uidvalidity, uidnext, highestmodseq, rules, runs)
+        )
+        self.db.commit()
+
+    def evict(self):
+        '''
+        Removes the least recently used emails until there are no more than `self.max_entries`
+        '''
+        count = self.db.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM emails WHERE rowid IN (SELECT rowid FROM emails ORDER BY used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        '''
+        Closes the database
+        '''
+        self.db.close()
+
+
+class SenderIndex():
+    def __init__(self):
+        '''
+        An index of blocked senders, which can be exact addresses (eg: `news@example.edu`),
+        every address at a domain (`*@marketing.example.edu`) or every address at any subdomain
+        of a domain (`*.example.edu`). Exact addresses are kept in a hash table and domains in a trie
+        keyed by the parts of the domain in reverse (`edu` -> `example` -> `marketing`), so looking
+        up a sender costs one step per part of its domain no matter how many rules there are
+        '''
+        # {pattern: {Gmail labels the sender is blocked in (None for any)}}
+        self.rules = {}
+        self.addresses = {}
+        # each node is a list of its children (keyed by domain part) and the labels that block
+        # every address at the domain and at any subdomain of it
+        self.domains = [{}, set(), set()]
+
+    def add(self, pattern, scope=None):
+        '''
+        Adds a sender to the index
+
+        Args:
+            pattern (str): an address or domain pattern (see `sender_pattern`)
+            scope (str): the Gmail label (see `gmail_label`) emails from the sender are blocked in.
+                None for any label
+        '''
+        pattern = normalize_address(pattern)
+        self.rules.setdefault(pattern, set()).add(scope)
+        wildcard = sender_pattern(pattern)
+        if wildcard is None:
+            self.addresses.setdefault(pattern, set()).add(scope)
+            return
+        kind, domain = wildcard
+        node = self.domains
+        for part in reversed(domain.split('.')):
+            node = node[0].setdefault(part, [{}, set(), set()])
+        node[1 if kind == 'domain' else 2].add(scope)
+
+    def get(self, address, default=None):
+        '''
+        Looks up who blocks a sender
+
+        Args:
+            address (str): the sender's address (see `normalize_address`)
+            default: what to return if the sender isn't blocked
+
+        Returns:
+            set: the Gmail labels the sender is blocked in (None for any)
+        '''
+        scopes = set(self.addresses.get(address, ()))
+        domain = address.rpartition('@')[2]
+        parts = domain.split('.')
+        node = self.domains
+        for i in range(len(parts) - 1, -1, -1):
+            node = node[0].get(parts[i])
+            if node is None:
+                break
+            # the rest of the domain is a subdomain of this node's domain
+            scopes.update(node[1] if i == 0 else node[2])
+        return scopes or default
+
+    def keys(self):
+        return self.rules.keys()
+
+    def values(self):
+        return self.rules.values()
+
+    def items(self):
+        return self.rules.items()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+
+class PhraseMatcher():
+    def __init__(self):
+        '''
+        Finds every one of a group of phrases in a piece of text in a single pass over the text
+        (the Aho-Corasick algorithm). The phrases are built into a trie with links from each node to
+        the longest suffix of it that is also in the trie, so the text never has to be re-read
+        when a partial match fails
+        '''
+        # each state is the index of a node. State 0 is the root
+        self.children = [{}]
+        self.fail = [0]
+        # the values of the phrases that end at each node, including those reached through `self.fail`
+        self.outputs = [set()]
+        self.built = True
+
+    def add(self, phrase, value):
+        '''
+        Adds a phrase to look for
+
+        Args:
+            phrase (str): the phrase
+            value: what to report when the phrase is found (eg: the index of a rule)
+        '''
+        state = 0
+        for char in phrase:
+            if char not in self.children[state]:
+                self.children.append({})
+                self.fail.append(0)
+                self.outputs.append(set())
+                self.children[state][char] = len(self.children) - 1
+            state = self.children[state][char]
+        self.outputs[state].add(value)
+        self.built = False
+
+    def build(self):
+        '''
+        Works out the failure links. Done automatically before the first search after a phrase is added
+        '''
+        queue = deque(self.children[0].values())
+        for state in queue:
+            self.fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, child in self.children[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.children[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.children[fail].get(char, 0)
+                self.outputs[child] |= self.outputs[self.fail[child]]
+                queue.append(child)
+        self.built = True
+
+    def search(self, text):
+        '''
+        Args:
+            text (str): the text to search
+
+        Returns:
+            set: the values of every phrase found in the text
+        '''
+        if not self.built:
+            self.build()
+        found = set()
+        state = 0
+        children, fail, outputs = self.children, self.fail, self.outputs
+        for char in text:
+            while state and char not in children[state]:
+                state = fail[state]
+            state = children[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+    def __bool__(self):
+        return len(self.children) > 1
+
+
+class PhraseIndex():
+    def __init__(self):
+        '''
+        An index of rules that look for a phrase anywhere in the subject and/or body of an email
+        (see `_phrase_rule`). Each field gets a `PhraseMatcher` covering every rule, so checking an
+        email scans each field once no matter how many rules there are.
+        Like an IMAP search, phrases are matched regardless of case
+        '''
+        # (filter, Gmail label the rule applies to or None for any)
+        self.rules = []
+        self.matchers = {'subject': PhraseMatcher(), 'body': PhraseMatcher()}
+
+    @property
+    def body(self):
+        '''
+        Whether any of the rules need the bodies of emails
+        '''
+        return bool(self.matchers['body'])
+
+    def add(self, filter, scope=None):
+        '''
+        Adds a rule to the index
+
+        Args:
+            filter (dict): the filter (see `_phrase_rule`)
+            scope (str): the Gmail label (see `gmail_label`) the rule applies to. None for any label
+        '''
+        self.rules.append((filter, scope))
+        for field, matcher in self.matchers.items():
+            if filter.get(field):
+                matcher.add(filter['search'].lower(), len(self.rules) - 1)
+
+    def match(self, email):
+        '''
+        Checks an email (as returned by `Server.get_emails_by_id`) against every rule
+
+        Returns:
+            set: the scopes of the rules that the email matches (see `self.add`)
+        '''
+        hits = {}
+        for field, matcher in self.matchers.items():
+            hits[field] = matcher.search(email[field].lower()) if matcher and email.get(field) else set()
+
+        scopes = set()
+        for i in hits['subject'] | hits['body']:
+            filter, scope = self.rules[i]
+            found = [i in hits[field] for field in self.matchers.keys() if filter.get(field)]
+            if all(found) if filter.get('all_match', True) else any(found):
+                scopes.add(scope)
+        return scopes
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class PatternSet():
+    def __init__(self):
+        '''
+        The regular expressions of a group of filters (see `validate_filter`). The patterns that look at the same
+        field are merged into one alternation with a named group for each pattern, so each field of an email
+        is scanned once no matter how many patterns there are
+        '''
+        # {field: {pattern: group name}}
+        self.fields = {}
+        # {field: merged pattern}, built the first time each field is needed
+        self.merged = {}
+        # patterns with their own flags or references to their own groups would change meaning once merged,
+        # so they are left out and checked on their own
+        self.alone = set()
+
+    @property
+    def body(self):
+        '''
+        Whether any of the patterns need the bodies of emails
+        '''
+        return 'body' in self.fields
+
+    def add(self, pattern, field):
+        '''
+        Adds a pattern to the set
+
+        Args:
+            pattern (str): the pattern
+            field (str): the field of an email that it looks at (see `SEARCH_KEYS`)
+        '''
+        names = self.fields.setdefault(field, {})
+        if pattern not in names:
+            names[pattern] = f'p{len(names)}'
+            if not _mergeable(pattern):
+                self.alone.add(pattern)
+            self.merged.pop(field, None)
+
+    def __merge(self, field):
+        '''
+        Internal function to build the alternation of every pattern that looks at a field
+        '''
+        if field not in self.merged:
+            names = self.fields[field]
+            groups = [f'(?P<{name}>{pattern})' for pattern, name in names.items() if pattern not in self.alone]
+            self.merged[field] = compile_pattern('|'.join(groups)) if groups else None
+        return self.merged[field]
+
+    def search(self, email, field, pattern, found):
+        '''
+        Checks whether a pattern matches a field of an email
+
+        Args:
+            email (dict): the email (as returned by `Server.get_emails_by_id`)
+            field (str): the field
+            pattern (str): the pattern, which must have been added to the set
+            found (dict): the results of scanning each field of this email so far. Starts off with just
+                the 'deadline' (see `time.perf_counter`) after which the email shouldn't be checked any more
+
+        Returns:
+            bool
+
+        Raises:
+            TimeoutError: if the deadline has passed
+        '''
+        if time.perf_counter() > found['deadline']:
+            raise TimeoutError
+        if field not in found:
+            text = (email['from']['raw'] if field == 'from' else email.get(field)) or ''
+            merged = self.__merge(field)
+            found[field] = (text, set(m.lastgroup for m in merged.finditer(text)) if merged is not None else set())
+        text, names = found[field]
+        if self.fields[field][pattern] in names:
+            return True
+        if not names and pattern not in self.alone:
+            # nothing matched the alternation, so none of the patterns in it can match
+            return False
+        # patterns can overlap, so one that lost out to another at the same place may still match elsewhere
+        return compile_pattern(pattern).search(text) is not None
+
+    def __len__(self):
+        return len(set(pattern for names in self.fields.values() for pattern in names))
+
+
+class Predicate():
+    def __init__(self, rules):
+        '''
+        Compiles a list of rules into a single check of an email. Each rule is a list of filters that must all
+        match (see `_exact_parts`). Every filter is turned into closures over its search term, with anything that
+        can be worked out from the term alone (sender patterns, body digests) done up front, so checking
+        an email doesn't look anything up in the filters.
+        Exact matches are checked with `_exact_check` and regular expressions using a `PatternSet`
+
+        Args:
+            rules (list): the rules
+        '''
+        self.patterns = PatternSet()
+        # whether any of the rules need the bodies of emails
+        self.body = any(f.get('body') for parts in rules for f in parts)
+        self.checks = [_match_all([self.__compile(f) for f in parts]) for parts in rules]
+
+    @property
+    def digest(self):
+        '''
+        Whether the 'body_digest' of each email is all that's needed (see `AsyncServer.fetch`).
+        Regular expressions need the whole body
+        '''
+        return not self.patterns.body
+
+    def __compile(self, filter):
+        '''
+        Internal function to compile a filter into a function that takes an email and the results of scanning it
+        for regular expressions (see `PatternSet.search`)
+        '''
+        query = filter['search']
+        fields = [field for field, _ in SEARCH_KEYS if filter.get(field)]
+        if filter.get('regex'):
+            for field in fields:
+                self.patterns.add(query, field)
+            checks = [_regex_check(self.patterns, field, query) for field in fields]
+            return _match_all(checks) if filter.get('all_match', True) else _match_any(checks)
+        # exact matches only need one of the fields to match. The search has already checked the others contain it
+        return _match_any([_exact_check(field, query) for field in fields])
+
+    def __call__(self, email, rules=None):
+        '''
+        Checks an email. Once checking the email has taken more than `REGEX_TIME_BUDGET` seconds,
+        the rest of its regular expressions are skipped and it doesn't match.
+        The budget is only checked between scans and can't interrupt one, so patterns that could take
+        exponential time are rejected before they get here as far as possible (see `check_pattern`)
+
+        Args:
+            email (dict): the email (as returned by `Server.get_emails_by_id`)
+            rules (list): the indexes of the rules to check. Defaults to all of them
+
+        Returns:
+            bool: whether the email matches any of the rules
+        '''
+        found = {'deadline': time.perf_counter() + REGEX_TIME_BUDGET} if self.patterns else None
+        checks = self.checks
+        try:
+            if rules is None:
+                for check in checks:
+                    if check(email, found):
+                        return True
+            else:
+                for i in rules:
+                    if checks[i](email, found):
+                        return True
+        except TimeoutError:
+            pass
+        return False
+
+
+class IDSet():
+    def __init__(self, ids=()):
+        '''
+        An immutable set of email IDs (UIDs or sequence numbers).
+        The IDs are stored as sorted ranges of consecutive IDs rather than one by one. The IDs in a
+        label are mostly consecutive, so even a million of them only take up a few bytes.
+        Supports the same operators as a frozenset (`|`, `&`, `-`, `in`, `len`), without ever
+        expanding the ranges, and `str` gives the IDs in IMAP sequence-set syntax (eg: `101:180,190`)
+
+        Args:
+            ids (iterable): the IDs (ints or bytes), or another IDSet
+        '''
+        if isinstance(ids, IDSet):
+            # the ranges are never modified once built so they can be shared
+            self.__starts, self.__ends, self.__length = ids.__starts, ids.__ends, ids.__length
+            return
+        self.__starts = array('I')
+        self.__ends = array('I')
+        self.__length = 0
+        for i in sorted(int(i) for i in ids):
+            self.__append(i, i)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        '''
+        Creates a set from ranges of IDs
+
+        Args:
+            ranges (iterable): the `(start, end)` ranges (both inclusive). They can be in any order and can overlap
+
+        Returns:
+            IDSet
+        '''
+        result = cls()
+        for start, end in sorted((min(start, end), max(start, end)) for start, end in ranges):
+            result.__append(start, end)
+        return result
+
+    def __append(self, start, end):
+        '''
+        Internal function to add a range of IDs that doesn't start before the last range
+        '''
+        if self.__ends and start <= self.__ends[-1] + 1:
+            if end > self.__ends[-1]:
+                self.__length += end - self.__ends[-1]
+                self.__ends[-1] = end
+        else:
+            self.__starts.append(start)
+            self.__ends.append(end)
+            self.__length += end - start + 1
+
+    def ranges(self):
+        '''
+        Returns:
+            iterator: the `(start, end)` ranges (both inclusive) of consecutive IDs, in order
+        '''
+        return zip(self.__starts, self.__ends)
+
+    def __len__(self):
+        return self.__length
+
+    def __bool__(self):
+        return self.__length > 0
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            yield from range(start, end + 1)
+
+    def __contains__(self, item):
+        if type(item) not in (int, bytes):
+            return False
+        item = int(item)
+        i = bisect_right(self.__starts, item) - 1
+        return i >= 0 and item <= self.__ends[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (set, frozenset)):
+            other = IDSet(other)
+        if not isinstance(other, IDSet):
+            return NotImplemented
+        return self.__starts == other.__starts and self.__ends == other.__ends
+
+    def __str__(self):
+        return ','.join(str(start) if start == end else f'{start}:{end}' for start, end in self.ranges())
+
+    def __repr__(self):
+        return f'IDSet({str(self)!r})'
+
+    def min(self):
+        if not self:
+            raise ValueError('IDSet is empty')
+        return self.__starts[0]
+
+    def max(self):
+        if not self:
+            raise ValueError('IDSet is empty')
+        return self.__ends[-1]
+
+    def union(self, other):
+        '''
+        Args:
+            other (iterable): IDs (see `self.__init__`)
+
+        Returns:
+            IDSet: the IDs that are in either set
+        '''
+        result = IDSet()
+        for start, end in merge(self.ranges(), IDSet(other).ranges()):
+            result.__append(start, end)
+        return result
+
+    def intersection(self, other):
+        '''
+        Args:
+            other (iterable): IDs (see `self.__init__`)
+
+        Returns:
+            IDSet: the IDs that are in both sets
+        '''
+        other = IDSet(other)
+        result = IDSet()
+        i = j = 0
+        while i < len(self.__starts) and j < len(other.__starts):
+            start = max(self.__starts[i], other.__starts[j])
+            end = min(self.__ends[i], other.__ends[j])
+            if start <= end:
+                result.__append(start, end)
+            if self.__ends[i] < other.__ends[j]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def difference(self, other):
+        '''
+        Args:
+            other (iterable): IDs (see `self.__init__`)
+
+        Returns:
+            IDSet: the IDs that are in this set but not `other`
+        '''
+        other = IDSet(other)
+        result = IDSet()
+        j = 0
+        for start, end in self.ranges():
+            # skip the ranges that end before this one starts. The rest may overlap later ranges as well
+            while j < len(other.__starts) and other.__ends[j] < start:
+                j += 1
+            k = j
+            while k < len(other.__starts) and other.__starts[k] <= end and start <= end:
+                if other.__starts[k] > start:
+                    result.__append(start, other.__starts[k] - 1)
+                start = max(start, other.__ends[k] + 1)
+                k += 1
+            if start <= end:
+                result.__append(start, end)
+        return result
+
+    def chunks(self, size):
+        '''
+        Splits the set into smaller sets, in order
+
+        Args:
+            size (int): the max number of IDs in each set
+
+        Returns:
+            generator: yields each IDSet
+        '''
+        chunk = IDSet()
+        for start, end in self.ranges():
+            while start <= end:
+                stop = min(end, start + size - len(chunk) - 1)
+                chunk.__append(start, stop)
+                start = stop + 1
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = IDSet()
+        if chunk:
+            yield chunk
+
+    __or__ = __ror__ = union
+    __and__ = __rand__ = intersection
+    __sub__ = difference
+
+    def __rsub__(self, other):
+        return IDSet(other).difference(self)
+
+
+async def _stage(source, record, name, size=None):
+    '''
+    Internal function to run one stage of a streaming pipeline in the background.
+    Items from `source` are put into a bounded queue as they're produced, so the stage can only
+    get `size` items ahead of whatever is consuming them and memory use doesn't depend on
+    the number of items
+
+    Args:
+        source (async generator): the stage (eg: `AsyncServer.fetch`)
+        record (callable): called with the name of the stage, the number of items and when it
+            started producing them (see `AsyncServer._record`). Time spent waiting for the
+            queue to have space isn't counted
+        name (str): the name of the stage
+        size (int): the max number of items to queue up. Defaults to `STAGE_QUEUE_SIZE`
+
+    Returns:
+        async generator: yields each item from `source`
+    '''
+    queue = asyncio.Queue(STAGE_QUEUE_SIZE if size is None else size)
+    done = object()
+    error = None
+
+    async def produce():
+        nonlocal error
+        try:
+            start = time.perf_counter()
+            async for item in source:
+                record(name, 1, start)
+                await queue.put(item)
+                start = time.perf_counter()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            # the source may be holding the connection's lock (see `AsyncServer._pipeline`)
+            await source.aclose()
+        await queue.put(done)
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        if error is not None:
+            raise error
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def _for_each_label(server, func, labels):
+    '''
+    Internal function to await `func(server, label)` for each label.
+    If `server` is an `AsyncServerPool` then the labels are handled concurrently
+
+    Returns:
+        dict: the return value of `func` for each label, skipping any that returned None
+    '''
+    if isinstance(server, AsyncServerPool):
+        async def worker(label):
+            async with server.session() as session:
+                return await func(session, label)
+
+        returns = dict(zip(labels, await asyncio.gather(*(worker(label) for label in labels))))
+    else:
+        returns = {}
+        for label in labels:
+            returns[label] = await func(server, label)
+    return {k: v for k, v in returns.items() if v is not None}
+
+
+def resolve_label(label, labels):
+    '''
+    Works out the full name of a label, so that different ways of writing the same label
+    (eg: 'starred', 'Starred' and '[Gmail]/Starred') all resolve to the same thing
+
+    Args:
+        label (str): the label to resolve
+        labels (dict): the labels in the user's account (see `Server.get_labels`)
+
+    Returns:
+        str
+    '''
+    if label.upper() == 'INBOX':
+        return 'INBOX'
+    for k, v in labels.items():
+        if label.lower() in (k.lower(), v.lower()):
+            return v
+    return label
+
+
+def gmail_label(label, special_labels):
+    '''
+    Works out how a label appears in the X-GM-LABELS of an email (see `AsyncServer.get_gmail_labels`)
+
+    Args:
+        label (str): the full name of the label (eg: '[Gmail]/Starred')
+        special_labels (dict): the labels with special uses (see `AsyncServer.get_labels`)
+
+    Returns:
+        str: eg: '\\Starred'
+    '''
+    if label.upper() == 'INBOX':
+        return '\\Inbox'
+    for use, name in special_labels.items():
+        if name == label and use in GMAIL_SYSTEM_LABELS:
+            return GMAIL_SYSTEM_LABELS[use]
+    return label
+
+
+def _exact_parts(filter):
+    '''
+    Internal function to get the parts of a filter (itself and its sub-filters) that need checking locally,
+    because they need exact matching or are regular expressions
+    '''
+    return [f for f in [filter] + filter.get('sub_filters', []) if f.get('exact_match', True) or f.get('regex')]
+
+
+def _quote(value):
+    '''
+    Internal function to wrap a string in quotes for use in an IMAP command
+    '''
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _imap_or(terms):
+    '''
+    Internal function to join IMAP search keys with OR. IMAP's OR only takes 2 arguments
+    so more than 2 keys are nested, eg: `OR a OR b c`
+    '''
+    if len(terms) == 1:
+        return terms[0]
+    return f'OR {terms[0]} {_imap_or(terms[1:])}'
+
+
+def compile_search(filter):
+    '''
+    Compiles a filter (as produced by `validate_filter`), including all of its sub-filters,
+    into a single IMAP search expression.
+    Exact matching can't be expressed in IMAP so the expression will match
+    every email that contains the search term in the relevant fields.
+    Regular expressions can't be searched for at all so they match every email
+
+    Args:
+        filter (dict): the filter to compile
+
+    Returns:
+        str: the search expression, eg: `(OR FROM "a@b.com" SUBJECT "a@b.com" (BODY "xyz"))`
+
+    Raises:
+        Exception: if a valid search query could not be constructed
+    '''
+    terms = [f'{key} {_quote(_search_term(filter, field))}' for field, key in SEARCH_KEYS if filter.get(field)]
+    if terms == []:
+        raise Exception('Could not create valid search query from your arguments')
+
+    if filter.get('regex'):
+        check_pattern(filter['search'])
+        expression = ['ALL']
+    elif filter.get('all_match', True) or len(terms) == 1:
+        expression = [' '.join(terms)]
+    else:
+        expression = [_imap_or(terms)]
+    for sub_filter in filter.get('sub_filters', []):
+        expression.append(compile_search(sub_filter))
+    return f'({" ".join(expression)})'
+
+
+def compile_gmail_raw(filter):
+    '''
+    Compiles a filter (as produced by `validate_filter`), including all of its sub-filters,
+    into a single Gmail search (the same syntax as the Gmail search bar) to be sent using X-GM-RAW.
+    Gmail has no way to search the body of an email on its own so body searches
+    will match the search term anywhere in the email
+
+    Args:
+        filter (dict): the filter to compile
+
+    Returns:
+        str: the search expression, eg: `X-GM-RAW "{from:(\\"a@b.com\\") subject:(\\"a@b.com\\")}"`.
+            `ALL` if every part of the filter is a regular expression
+
+    Raises:
+        Exception: if a valid search query could not be constructed
+    '''
+    def compile_raw(filter):
+        terms = []
+        for field, _ in SEARCH_KEYS:
+            if filter.get(field):
+                # gmail has no way to escape quotes inside of a phrase
+                query = '"' + _search_term(filter, field).replace('"', ' ') + '"'
+                terms.append(query if field == 'body' else f'{field}:({query})')
+        if terms == []:
+            raise Exception('Could not create valid search query from your arguments')
+
+        if filter.get('regex'):
+            # checked locally, like `compile_search`
+            expression = []
+        elif filter.get('all_match', True) or len(terms) == 1:
+            expression = [f'({" ".join(terms)})']
+        else:
+            expression = ['{' + ' '.join(terms) + '}']
+        for sub_filter in filter.get('sub_filters', []):
+            expression.append(compile_raw(sub_filter))
+        return ' '.join(expression)
+
+    raw = compile_raw(filter)
+    return f'X-GM-RAW {_quote(raw)}' if raw else 'ALL'
+
+
+def _match_all(checks):
+    '''
+    Internal function to combine the checks of a `Predicate` into one that passes if all of them do
+    '''
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(email, found):
+        for check in checks:
+            if not check(email, found):
+                return False
+        return True
+    return check
+
+
+def _match_any(checks):
+    '''
+    Internal function to combine the checks of a `Predicate` into one that passes if any of them do
+    '''
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(email, found):
+        for check in checks:
+            if check(email, found):
+                return True
+        return False
+    return check
+
+
+def _regex_check(patterns, field, pattern):
+    '''
+    Internal function to build the check of a `Predicate` for a regular expression in one field of an email
+    '''
+    search = patterns.search
+
+    def check(email, found):
+        return search(email, field, pattern, found)
+    return check
+
+
+def _exact_check(field, query):
+    '''
+    Internal function to build the check of a `Predicate` for an exact match of one field of an email.
+    A sender matches if the whole From header is the search term, or if its address (see `sender_address`)
+    is the search term or is covered by its domain pattern (see `sender_pattern`).
+    Emails from the cache (see `EmailCache`) only have a digest of their body, which is compared instead
+    '''
+    if field == 'from':
+        # addresses are compared like a blocklist would (see `sender_address`), regardless of case
+        wildcard = sender_pattern(query)
+        if wildcard is None:
+            address = normalize_address(query)
+
+            def check(email, found):
+                sender = email['from']
+                return query == sender['raw'] or sender['address'] == address
+            return check
+
+        kind, domain = wildcard
+        suffix = '.' + domain
+
+        def check(email, found):
+            sender = email['from']
+            if query == sender['raw']:
+                return True
+            if sender['address'] is None:
+                return False
+            sender_domain = sender['address'].rpartition('@')[2]
+            return sender_domain == domain if kind == 'domain' else sender_domain.endswith(suffix)
+        return check
+
+    if field == 'body':
+        digest = body_digest(query)
+
+        def check(email, found):
+            body = email['body']
+            if body is None and email.get('body_digest') is not None:
+                # emails from the cache (see `EmailCache`) only have a digest of their body
+                return email['body_digest'] == digest
+            return body == query
+        return check
+
+    def check(email, found):
+        return email[field] == query
+    return check
+
+
+def body_digest(body):
+    '''
+    Gets a digest of the body of an email, so that it can be checked for an exact match
+    without having to store the whole thing
+
+    Args:
+        body (str): the body
+
+    Returns:
+        str
+    '''
+    return hashlib.sha1(body.encode(errors='replace')).hexdigest()
+
+
+def _tokenize_response(data):
+    '''
+    Internal function to split the data of a server response (in the format imaplib uses)
+    into tokens. Literals are returned as bytes, the brackets of lists as
+    `'('` and `')'` and everything else as a str
+    '''
+    for part in data:
+        if type(part) == tuple:
+            text, literal = part
+        else:
+            text, literal = part, None
+        if text is None:
+            continue
+        text = text.decode(errors='replace')
+        if literal is not None:
+            # strip the literal's length marker "{123}" off the end
+            text = text[:text.rindex('{')]
+
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == ' ':
+                i += 1
+            elif char in '()':
+                yield char
+                i += 1
+            elif char == '"':
+                j = i + 1
+                value = ''
+                while j < len(text) and text[j] != '"':
+                    if text[j] == '\\':
+                        j += 1
+                    value += text[j]
+                    j += 1
+                yield value
+                i = j + 1
+            else:
+                # atoms can contain brackets with spaces in them, eg: BODY[HEADER.FIELDS (FROM)]
+                j = i
+                depth = 0
+                while j < len(text) and (depth or text[j] not in ' ()"'):
+                    if text[j] == '[':
+                        depth += 1
+                    elif text[j] == ']':
+                        depth -= 1
+                    j += 1
+                atom = text[i:j]
+                yield None if atom == 'NIL' else atom
+                i = j
+        if literal is not None:
+            yield literal
+
+
+def _response_text(data):
+    '''
+    Internal function to get the text of a response (eg: the reason a command failed)
+    '''
+    text = data[0][0] if type(data[0]) == tuple else data[0]
+    return text.decode(errors='replace')
+
+
+def response_codes(data):
+    '''
+    Gets the response codes (eg: `[UIDVALIDITY 123]`) out of the data of some responses
+
+    Args:
+        data (list): the response data, in the format imaplib uses
+
+    Returns:
+        dict: the value of each response code (bytes decoded to str), keyed by the code
+    '''
+    codes = {}
+    for part in data:
+        text = part[0] if type(part) == tuple else part
+        match = RESPONSE_CODE_REGEX.match(text)
+        if match is not None:
+            codes[match.group(1).decode().upper()] = match.group(2).decode(errors='replace')
+    return codes
+
+
+def parse_response(data):
+    '''
+    Parses the data of a server response (in the format imaplib uses) into python objects.
+    Lists become lists, literals become bytes, NIL becomes None and everything else is a str
+
+    Args:
+        data (list): the response data
+
+    Returns:
+        list
+    '''
+    stack = [[]]
+    for token in _tokenize_response(data):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        else:
+            stack[-1].append(token)
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    return stack[0]
+
+
+def parse_esearch_response(data):
+    '''
+    Parses the response of a `SEARCH RETURN (...)` command (RFC 4731)
+
+    Args:
+        data (list): the response data, in the format imaplib uses
+
+    Returns:
+        dict: 'ALL' is the matching IDs (IDSet), 'COUNT' is the number of matches and 'MIN' and 'MAX'
+            are the lowest and highest matching IDs (None if nothing matched)
+    '''
+    result = {'ALL': IDSet(), 'COUNT': 0, 'MIN': None, 'MAX': None}
+    # the correlator (eg: `(TAG "EB5")`) is a list and the UID marker has no value so neither are in pairs
+    tokens = [i for i in parse_response(data) if type(i) == str and i.upper() != 'UID']
+    for key, value in zip(tokens[::2], tokens[1::2]):
+        key = key.upper()
+        if key == 'ALL':
+            result['ALL'] = parse_sequence_set(value)
+        elif key in ('COUNT', 'MIN', 'MAX'):
+            result[key] = int(value)
+    return result
+
+
+def parse_fetch_response(data):
+    '''
+    Splits the response of a (possibly multi-message) FETCH command into one dict per message
+
+    Args:
+        data (list): the response data, in the format imaplib uses
+
+    Returns:
+        generator: yields a dict for each message. The keys are the names of the fetched items
+            (eg: 'UID', 'RFC822', 'BODY[HEADER]') plus 'SEQ' for the sequence number of the message.
+            'UID', 'SEQ' and 'X-GM-MSGID' are converted to ints
+    '''
+    parsed = parse_response(data)
+    for i in range(len(parsed) - 1):
+        seq, items = parsed[i], parsed[i + 1]
+        if type(seq) != str or not seq.isdigit() or type(items) != list:
+            continue
+        message = {'SEQ': int(seq)}
+        for j in range(0, len(items) - 1, 2):
+            key = items[j].upper() if type(items[j]) == str else items[j]
+            message[key] = items[j + 1]
+        for key in ('UID', 'X-GM-MSGID'):
+            if key in message:
+                message[key] = int(message[key])
+        yield message
+
+
+def parse_email(email_id, header, body=None):
+    '''
+    Parses a fetched email into the dict returned by `Server.get_emails_by_id`
+    '''
+    parser = HeaderParser()
+    head_data = parser.parsestr(header.decode(errors='replace'))
+    info = {
+        'id': email_id,
+        'from': {
+            'raw': head_data['from'],
+            'email': None,
+            'name': None,
+            # the address as senders are compared (see `sender_address`)
+            'address': None
+        },
+        'to': head_data['to'],
+        'cc': head_data['cc'],
+        'bcc': head_data['bcc'],
+        'date': head_data['date'],
+        'subject': head_data.get('subject'),
+        'body': body
+    }
+    # the "from" of an email is usually returned as "John Smith <johnsmith@gmail.com>"
+    # so let's parse that real quick
+    addresses = [i for i in getaddresses([info['from']['raw'] or '']) if i[1]]
+    if addresses and email_valid(addresses[0][1]):
+        info['from']['name'] = _decode_header(addresses[0][0]) or None
+        info['from']['email'] = addresses[0][1]
+        info['from']['address'] = normalize_address(addresses[0][1])
+    # headers can be encoded (eg: `=?UTF-8?Q?Big_Sale?=`). The server decodes them when searching
+    # so they have to be decoded for anything that checks them locally to work the same way
+    info['from']['raw'] = _decode_header(info['from']['raw'])
+    for key in ('to', 'cc', 'bcc', 'subject'):
+        info[key] = _decode_header(info[key])
+
+    return info
+
+
+def _decode_header(value):
+    '''
+    Internal function to decode any encoded words (RFC 2047) in a header. Headers that can't be
+    decoded are left as they are
+    '''
+    if value is None or '=?' not in value:
+        return value
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def find_text_part(structure, section=''):
+    '''
+    Searches the BODYSTRUCTURE of an email for the plain text part of the email
+
+    Args:
+        structure (list): the parsed BODYSTRUCTURE (see `parse_response`)
+        section (str): the section number of `structure`. Used when recursing
+
+    Returns:
+        tuple: the section number (eg: '1.2'), the transfer encoding and the charset of the part
+        None: if the email has no plain text part
+    '''
+    if type(structure) != list or len(structure) < 2:
+        return None
+
+    if type(structure[0]) == list:
+        # multipart. The sub-parts come first, followed by the multipart subtype
+        for index, part in enumerate(structure):
+            if type(part) != list:
+                break
+            found = find_text_part(part, f'{section}.{index + 1}' if section else str(index + 1))
+            if found is not None:
+                return found
+        return None
+
+    if str(structure[0]).upper() != 'TEXT' or str(structure[1]).upper() != 'PLAIN':
+        return None
+    # skip any text files that have been attached to the email
+    if len(structure) > 9 and type(structure[9]) == list and str(structure[9][0]).upper() == 'ATTACHMENT':
+        return None
+
+    params = structure[2] if type(structure[2]) == list else []
+    params = {str(params[i]).upper(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+    encoding = structure[5] if len(structure) > 5 and structure[5] else '7BIT'
+    return section or '1', encoding.upper(), params.get('CHARSET') or 'utf-8'
+
+
+def decode_part(data, encoding, charset):
+    '''
+    Decodes a part of an email that was fetched from the server
+
+    Args:
+        data (bytes): the raw part
+        encoding (str): the Content-Transfer-Encoding of the part
+        charset (str): the charset of the part
+
+    Returns:
+        str
+    '''
+    if encoding == 'BASE64':
+        data = re.sub(rb'\s+', b'', data)
+        # the part may have been cut short by a byte limit
+        data = base64.b64decode(data[:len(data) - (len(data) % 4)])
+    elif encoding == 'QUOTED-PRINTABLE':
+        data = quopri.decodestring(data)
+    try:
+        text = data.decode(charset, errors='replace')
+    except LookupError:
+        text = data.decode('utf-8', errors='replace')
+    return text.replace('\r\n', '\n').strip()
+
+
+def parse_sequence_set(sequence_set):
+    '''
+    Parses an IMAP sequence set (eg: `101:180,190`) as sent by the server, without expanding the ranges.
+    `*` isn't supported since the server never sends it
+
+    Args:
+        sequence_set (str): the sequence set
+
+    Returns:
+        IDSet
+    '''
+    ranges = []
+    for item in sequence_set.split(','):
+        start, _, end = item.partition(':')
+        ranges.append((int(start), int(end or start)))
+    return IDSet.from_ranges(ranges)
+
+
+def sequence_sets(ids, max_length=None):
+    '''
+    Compacts a group of email IDs into IMAP sequence-set syntax (eg: `101:180,190`).
+    Very fragmented groups are split across multiple sets so that no single command
+    gets too long for the server to accept
+
+    Args:
+        ids (iterable): the email IDs (ints or bytes, or an IDSet)
+        max_length (int): the maximum length of each sequence set.
+            Defaults to `SEQUENCE_SET_MAX_LENGTH`
+
+    Returns:
+        generator: yields each sequence set as a str
+    '''
+    if max_length is None:
+        max_length = SEQUENCE_SET_MAX_LENGTH
+    current = ''
+    for start, end in IDSet(ids).ranges():
+        item = str(start) if start == end else f'{start}:{end}'
+        if current and len(current) + len(item) + 1 > max_length:
+            yield current
+            current = ''
+        current = f'{current},{item}' if current else item
+    if current:
+        yield current
+
+
+def normalize_address(address):
+    '''
+    Normalizes an email address so that the same address is always written the same way
+
+    Args:
+        address (str): the address, eg: ` John.Smith@GMAIL.com`
+
+    Returns:
+        str: eg: `john.smith@gmail.com`
+    '''
+    return address.strip().strip('<>').lower()
+
+
+def sender_address(header):
+    '''
+    Gets who sent an email from its From header. Every kind of sender rule (see `_exact_check` and `SenderIndex`)
+    goes by this, so a rule matches the same emails no matter how many other rules there are
+
+    Args:
+        header (str): the From header, eg: `John Smith <John.Smith@gmail.com>`
+
+    Returns:
+        str: the address (see `normalize_address`), eg: `john.smith@gmail.com`. None if there isn't a valid one
+    '''
+    addresses = [address for _, address in getaddresses([header or '']) if address]
+    return normalize_address(addresses[0]) if addresses and email_valid(addresses[0]) else None
+
+
+def sender_pattern(pattern):
+    '''
+    Parses a pattern that matches every sender at a domain
+
+    Args:
+        pattern (str): `*@example.edu` to match any address at example.edu, or `*.example.edu`
+            (or `*@*.example.edu`) to match any address at a subdomain of example.edu
+
+    Returns:
+        tuple: 'domain' or 'subdomains' and the domain, eg: `('domain', 'example.edu')`.
+            None if it isn't a domain pattern
+    '''
+    pattern = normalize_address(pattern)
+    for prefix, kind in (('*@*.', 'subdomains'), ('*@', 'domain'), ('*.', 'subdomains')):
+        if pattern.startswith(prefix):
+            domain = pattern[len(prefix):]
+            return (kind, domain) if DOMAIN_REGEX.fullmatch(domain) else None
+    return None
+
+
+def _search_term(filter, field):
+    '''
+    Internal function to get what a field of an email should be searched for.
+    The server can't search for domain patterns (see `sender_pattern`) so senders are
+    searched for by domain and then checked locally
+    '''
+    if field == 'from':
+        wildcard = sender_pattern(filter['search'])
+        if wildcard is not None:
+            return wildcard[1]
+    return filter['search']
+
+
+def _phrase_rule(filter):
+    '''
+    Internal function to check whether a filter just looks for a phrase anywhere in the subject and/or body
+    of an email, with no sub-filters. These can be checked locally using a `PhraseIndex`
+
+    Returns:
+        bool
+    '''
+    if filter.get('exact_match', True) or filter.get('regex') or filter.get('sub_filters') or not filter['search']:
+        return False
+    if any(filter.get(field) for field, _ in SEARCH_KEYS if field not in ('subject', 'body')):
+        return False
+    return bool(filter.get('subject') or filter.get('body'))
+
+
+def _label_names(values):
+    '''
+    Internal function to convert the X-GM-LABELS of an email into a set of str
+    '''
+    return set(i.decode(errors='replace') if type(i) == bytes else i for i in values if i is not None)
+
+
+def _blocked_sender(filter):
+    '''
+    Internal function to get the address that a filter blocks, if all it does is block a sender
+    (an exact match of the sender's address or domain with no sub-filters, like the filters made from
+    `blocked_emails`).
+    These can be checked locally using a blocklist (see `AsyncServer.search_senders`)
+
+    Returns:
+        str: the address (see `normalize_address`), or None if the filter does more than that
+    '''
+    if not filter.get('from') or not filter.get('exact_match', True) or filter.get('sub_filters'):
+        return None
+    if filter.get('regex'):
+        return None
+    if any(filter.get(field) for field, _ in SEARCH_KEYS if field != 'from'):
+        return None
+    if not email_valid(filter['search'].strip()) and sender_pattern(filter['search']) is None:
+        return None
+    return normalize_address(filter['search'])
+
+
+@lru_cache(maxsize=None)
+def compile_pattern(pattern, flags=None):
+    '''
+    Compiles a regular expression. Patterns are cached by pattern and flags so each one is only compiled once
+
+    Args:
+        pattern (str): the pattern
+        flags (int): the flags to compile with. Defaults to `REGEX_FLAGS`
+
+    Returns:
+        re.Pattern
+
+    Raises:
+        re.error: if the pattern is invalid
+    '''
+    return re.compile(pattern, REGEX_FLAGS if flags is None else flags)
+
+
+def check_pattern(pattern):
+    '''
+    Checks that a regular expression can be used in a filter. Python can't interrupt a regular expression
+    once it has started, so patterns that repeat something that can already be repeated any number of times
+    (eg: `(a+)+`), or repeat a choice between alternatives that can start with the same character
+    (eg: `(a|aa)+`), are rejected. These can take exponential time to fail to match, which would stall a whole run.
+    The check is conservative but not exhaustive, so some slow patterns (eg: `a*a*a*b`) still get through
+
+    Args:
+        pattern (str): the pattern
+
+    Raises:
+        ValueError: if the pattern is invalid or could take exponential time
+    '''
+    try:
+        compile_pattern(pattern)
+    except re.error as e:
+        raise ValueError(f'"{pattern}" is not a valid regular expression: {e}')
+    parsed = sre_parse.parse(pattern, REGEX_FLAGS)
+    if _nested_repeat(parsed):
+        raise ValueError(
+            f'"{pattern}" repeats something that is already repeated (eg: (a+)+), which can take forever to check'
+        )
+    if _ambiguous_repeat(parsed):
+        raise ValueError(
+            f'"{pattern}" repeats a choice between alternatives that can match the same text (eg: (a|aa)+), '
+            'which can take forever to check'
+        )
+
+
+def _nested_repeat(parsed, repeated=False):
+    '''
+    Internal function to check whether a parsed regular expression has an unbounded repeat inside of
+    another one (see `check_pattern`)
+    '''
+    for op, av in parsed:
+        unbounded = False
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            unbounded = av[1] == sre_parse.MAXREPEAT
+            if unbounded and repeated:
+                return True
+        for value in av if isinstance(av, (tuple, list)) else (av,):
+            for sub in value if isinstance(value, list) else (value,):
+                if isinstance(sub, sre_parse.SubPattern) and _nested_repeat(sub, repeated or unbounded):
+                    return True
+    return False
+
+
+def _ambiguous_repeat(parsed, follow=frozenset(), repeated=False):
+    '''
+    Internal function to check whether a parsed regular expression has a choice inside of an unbounded repeat
+    where more than one option can start with the same character (see `check_pattern`).
+    Both alternations (eg: `(a|ab)+`) and optional parts (eg: `(a?a)+`) are choices.
+    `follow` is the characters that can come after `parsed` (see `_first_chars`)
+    '''
+    items = list(parsed)
+    for i, (op, av) in enumerate(items):
+        after = _first_chars(items[i + 1:], follow)
+        if op is sre_parse.BRANCH:
+            options = [_first_chars(branch, after) for branch in av[1]]
+            if repeated and any(_overlap(a, b) for j, a in enumerate(options) for b in options[j + 1:]):
+                return True
+            if any(_ambiguous_repeat(branch, after, repeated) for branch in av[1]):
+                return True
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, body = av
+            # each time round, the body can either be matched again or be followed by the rest of the pattern
+            if repeated and low != high and _overlap(_first_chars(body, after), after):
+                return True
+            unbounded = high == sre_parse.MAXREPEAT
+            if _ambiguous_repeat(body, _first_chars(body, after) if unbounded else after, repeated or unbounded):
+                return True
+        elif op is sre_parse.SUBPATTERN and _ambiguous_repeat(av[-1], after, repeated):
+            return True
+    return False
+
+
+def _first_chars(parsed, follow):
+    '''
+    Internal function to work out which characters a parsed regular expression can start with,
+    given the characters that can come after it (see `_ambiguous_repeat`).
+    Characters are lower case, classes like `\\d` are kept as their category (see `REGEX_CATEGORIES`)
+    and '' means it can match nothing at all.
+
+    Returns:
+        set: the characters, or None if it could start with anything
+    '''
+    chars = set()
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            first = {chr(av).lower()}
+        elif op is sre_parse.IN:
+            first = _charset(av)
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            first = {''}
+        elif op is sre_parse.SUBPATTERN:
+            first = _first_chars(av[-1], {''})
+        elif op is sre_parse.BRANCH:
+            options = [_first_chars(branch, {''}) for branch in av[1]]
+            first = None if None in options else set().union(*options)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            first = _first_chars(av[2], {''})
+            if first is not None and av[0] == 0:
+                first.add('')
+        else:
+            first = None
+        if first is None:
+            return None
+        chars |= first - {''}
+        if '' not in first:
+            return chars
+    return None if follow is None else chars | follow
+
+
+def _charset(items):
+    '''
+    Internal function to work out the characters matched by a parsed character class (eg: `[a-z\\d]`).
+    See `_first_chars`
+    '''
+    chars = set()
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av).lower())
+        elif op is sre_parse.RANGE and av[1] - av[0] < 256:
+            chars.update(chr(i).lower() for i in range(av[0], av[1] + 1))
+        elif op is sre_parse.CATEGORY and av in REGEX_CATEGORIES:
+            chars.add(av)
+        else:
+            return None
+    return chars
+
+
+def _overlap(a, b):
+    '''
+    Internal function to check whether two sets of characters from `_first_chars` have anything in common
+    '''
+    if a is None or b is None:
+        # anything overlaps with everything but the end of the pattern
+        return a is b or bool(a or b)
+    for x in a:
+        for y in b:
+            if isinstance(x, str) and isinstance(y, str):
+                if x == y:
+                    return True
+            elif isinstance(x, str) or isinstance(y, str):
+                char, category = (x, y) if isinstance(x, str) else (y, x)
+                if re.match(REGEX_CATEGORIES[category], char):
+                    return True
+            elif x == y or sre_parse.CATEGORY_SPACE not in (x, y):
+                return True
+    return False
+
+
+def _mergeable(pattern):
+    '''
+    Internal function to check whether a pattern means the same thing as part of a larger alternation
+    (see `PatternSet`). It can't set its own flags, name its own groups or refer back to its own groups.
+    Flags set for the whole pattern (eg: `(?i)`) aren't allowed anywhere but the start of an alternation,
+    even if they match `REGEX_FLAGS`
+    '''
+    compiled = compile_pattern(pattern)
+    if compiled.flags != compile_pattern('').flags or GLOBAL_FLAGS_REGEX.search(pattern):
+        return False
+    return not compiled.groupindex and not (compiled.groups and BACKREFERENCE_REGEX.search(pattern))
 
 
 def email_valid(email):
@@ -324,4 +3715,52 @@ def email_valid(email):
     return re.fullmatch(EMAIL_REGEX, email)
 
 
+# the filter fields that can be searched and their IMAP search keys
+SEARCH_KEYS = (('from', 'FROM'), ('cc', 'CC'), ('bcc', 'BCC'), ('subject', 'SUBJECT'), ('body', 'BODY'))
+SEQUENCE_SET_MAX_LENGTH = 8000
+# Gmail allows roughly 15 simultaneous connections per account
+MAX_CONNECTIONS = 15
+FETCH_BATCH_SIZE = 500
+PIPELINE_WINDOW = 8
+# the stages emails go through when searching (see `AsyncServer.throughput`)
+PIPELINE_STAGES = ('search', 'fetch', 'match', 'trash')
+STAGE_QUEUE_SIZE = 500
+# the max number of emails to list when asking whether to delete them
+PREVIEW_LIMIT = 200
+CACHE_MAX_ENTRIES = 200000
+# bumped whenever `parse_email` changes, so that emails parsed by older versions are dropped from the cache
+CACHE_VERSION = 1
+# re-IDLE well before the server's 30 minute timeout
+IDLE_TIMEOUT = 25 * 60
+# how long to wait before reconnecting after a dropped connection. This doubles with each failure
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 5 * 60
+READ_SIZE = 65536
+TAG_PREFIX = 'EB'
+RESPONSE_CODE_REGEX = re.compile(rb'\[([A-Za-z0-9-]+) ?([^\]]*)\]')
+LITERAL_REGEX = re.compile(rb'\{(\d+)\}$')
+RESPONSE_REGEX = re.compile(rb'(\S+) (?:(\d+) )?([A-Za-z-]+) ?(.*)', re.DOTALL)
+# special-use attributes of labels (RFC 6154), keyed by lower case so they can be matched case-insensitively
+SPECIAL_USES = {
+    i.lower(): i for i in ('\\All', '\\Archive', '\\Drafts', '\\Flagged', '\\Important', '\\Junk', '\\Sent', '\\Trash')
+}
+# how Gmail refers to labels with special uses in X-GM-LABELS
+GMAIL_SYSTEM_LABELS = {
+    '\\Flagged': '\\Starred', '\\Important': '\\Important', '\\Sent': '\\Sent', '\\Drafts': '\\Draft'
+}
+# the number of labels at which it becomes cheaper to scan All Mail once than to select each label
+ALL_MAIL_MIN_LABELS = 5
+# labels with at least this many filters that just block a sender check them all at once (see `_blocked_sender`)
+BLOCKLIST_MIN_SENDERS = 20
+# labels with at least this many filters that look for a phrase check them all at once (see `_phrase_rule`)
+PHRASE_MIN_RULES = 20
+# regular expression filters ignore case, like the server's searches. `(?-i:...)` can be used to match case
+REGEX_FLAGS = re.IGNORECASE
+# the character classes that `check_pattern` can tell apart
+REGEX_CATEGORIES = {sre_parse.CATEGORY_DIGIT: r'\d', sre_parse.CATEGORY_WORD: r'\w', sre_parse.CATEGORY_SPACE: r'\s'}
+# the max number of seconds to spend checking an email against regular expressions (see `Predicate`)
+REGEX_TIME_BUDGET = 0.5
+BACKREFERENCE_REGEX = re.compile(r'\\\d|\(\?\(')
+GLOBAL_FLAGS_REGEX = re.compile(r'\(\?[aiLmsux]+\)')
+DOMAIN_REGEX = re.compile(r'[a-z0-9-]+(\.[a-z0-9-]+)*')
 EMAIL_REGEX = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
@@ -222,7 +222,8 @@ class FilterManager(tk.Frame):
             'Subject',
             'Body',
             'Search must be present\nin ALL fields',
-            'Must match the\nsearch exactly', ''
+            'Must match the\nsearch exactly',
+            'Search is a regular\nexpression', ''
         ):
             self.top_bar.append(
                 tk.Label(
@@ -234,7 +235,7 @@ class FilterManager(tk.Frame):
 
         self.grid_columnconfigure(0, weight=1)
 
-    def _format_filter(self, filter, sub=False):
+    def _format_filter(self, filter, sub=False, strict=True):
         if type(filter) == tuple:
             if len(filter) == 10:
                 search, from_, cc, bcc, subject, body, label, all_match, exact_match, sub_filters = filter
@@ -261,7 +262,13 @@ class FilterManager(tk.Frame):
         if filter is None:
             filter = {}
         if type(filter) == dict:
-            filter = EmailBlocker.validate_filter(filter, sub=sub)
+            try:
+                filter = EmailBlocker.validate_filter(filter, sub=sub)
+            except ValueError:
+                # rows can be laid out while a regular expression is still being typed,
+                # so only complain about it when the filters are actually used
+                if strict:
+                    raise
         return filter
 
     def _create(self, item, focus=False, sub=False):
@@ -272,7 +279,7 @@ class FilterManager(tk.Frame):
         taken = []
         for i in self.rows():
             taken.append(i)
-            info = self.get_row(i)
+            info = self.get_row(i, strict=False)
             if info is not False:
                 if 'sub_filters' in info.keys():
                     major_rows[i] = info
@@ -321,7 +328,7 @@ class FilterManager(tk.Frame):
 
         a = 2
         ret = []
-        for i in ('from', 'cc', 'bcc', 'subject', 'body', 'all_match', 'exact_match'):
+        for i in ('from', 'cc', 'bcc', 'subject', 'body', 'all_match', 'exact_match', 'regex'):
             i = item[i]
             cb = tk.Checkbutton(self, bd=0, name=f'checkbuttonr{row}c{a}')
             cb.variable = tk.BooleanVar()
@@ -346,7 +353,7 @@ class FilterManager(tk.Frame):
 
     def remove_row(self, row, update=True):
         try:
-            r = self.get_row(row)
+            r = self.get_row(row, strict=False)
             for w in self.grid_slaves(row=row):
                 w.grid_remove()
                 w.grid_forget()
@@ -384,7 +391,7 @@ class FilterManager(tk.Frame):
                             candidates.append(r)
 
                 for r in candidates:
-                    row = self.get_row(r)
+                    row = self.get_row(r, strict=False)
                     if row is not False and row['search'] == '':
                         for w in self.grid_slaves(r):
                             if type(w) == tk.Entry and 'label' not in w._name:
@@ -398,16 +405,28 @@ class FilterManager(tk.Frame):
         self.update_colours()
 
     def load_filters(self):
+        '''
+        Shows the filters from the settings file. Invalid filters are still shown so that they can be fixed
+
+        Returns:
+            list: why each invalid filter is invalid
+        '''
+        errors = []
         for i in self.grid_slaves():
             if i not in self.top_bar:
                 i.destroy()
 
         for i in get_settings()['filters']:
-            self._create(self._format_filter(i))
+            try:
+                self._create(self._format_filter(i))
+            except ValueError as e:
+                errors.append(str(e))
+                self._create(self._format_filter(i, strict=False))
             if 'sub_filters' in i.keys():
                 for sub in i['sub_filters']:
-                    self._create(self._format_filter(sub), sub=True)
+                    self._create(self._format_filter(sub, sub=True, strict=False), sub=True)
         self.update_colours()
+        return errors
 
     def get_filters(self):
         config = []
@@ -426,8 +445,8 @@ class FilterManager(tk.Frame):
                 rows.append(i)
         return rows
 
-    def get_row(self, row):
-        names = ('from', 'cc', 'bcc', 'subject', 'body', 'all_match', 'exact_match')
+    def get_row(self, row, strict=True):
+        names = ('from', 'cc', 'bcc', 'subject', 'body', 'all_match', 'exact_match', 'regex')
         setting = {}
         if row < 0:
             row = self.rows()[row]
@@ -438,7 +457,7 @@ class FilterManager(tk.Frame):
                 if widget.grid_info()['row'] % 10 == 0:
                     sub_filters = []
                     for i in range(1, 10):
-                        tmp = self.get_row(row=widget.grid_info()['row'] + i)
+                        tmp = self.get_row(row=widget.grid_info()['row'] + i, strict=strict)
                         if tmp is not False and 'sub_filters' not in tmp.keys():
                             sub_filters.append(tmp)
                     setting['sub_filters'] = sub_filters
@@ -451,9 +470,9 @@ class FilterManager(tk.Frame):
         if setting == {}:
             return False
         elif 'sub_filters' not in setting.keys():
-            return self._format_filter(setting, sub=True)
+            return self._format_filter(setting, sub=True, strict=strict)
         else:
-            return self._format_filter(setting)
+            return self._format_filter(setting, strict=strict)
 
     def update_colours(self):
         a = 0
@@ -639,12 +658,28 @@ class Window():
                 if type(b) in (tk.Button, tk.Checkbutton):
                     b.config(state=tk.NORMAL)
 
+    def valid_inputs(self):
+        '''
+        Gets the inputs (see `self.get_inputs`), or shows why they aren't valid
+
+        Returns:
+            dict: the inputs, or None if any of the filters are invalid
+        '''
+        try:
+            return self.get_inputs()
+        except ValueError as e:
+            self.output(f'Invalid filter: {e}', 'red')
+            return None
+
     def save_settings(self, mode=0):
+        inputs = self.valid_inputs()
+        if inputs is None:
+            return
         if mode == 0:
-            save_settings(self.get_inputs())
+            save_settings(inputs)
         elif mode == 1:
             save_settings(
-                {**get_settings(), 'load_settings_on_launch': self.get_inputs()['load_settings_on_launch']}
+                {**get_settings(), 'load_settings_on_launch': inputs['load_settings_on_launch']}
             )
 
     def load_settings(self):
@@ -676,24 +711,35 @@ class Window():
                 if i not in filters:
                     filters.append(i)
             settings['filters'] = filters
-            self.filter_manager.load_filters()
+            errors = self.filter_manager.load_filters()
+            if errors:
+                self.output(f'Invalid filter: {errors[0]}', 'red')
         except Exception:
             pass
 
     def run(self):
-        set_settings(self.get_inputs())
+        inputs = self.valid_inputs()
+        if inputs is None:
+            return
+        set_settings(inputs)
         self.disable('run')
         EmailBlocker.run()
         self.enable('run')
 
     def StartupTask_create(self):
-        set_settings(self.get_inputs())
+        inputs = self.valid_inputs()
+        if inputs is None:
+            return
+        set_settings(inputs)
         self.disable('startup')
         EmailBlocker.StartupTask.create()
         self.enable('startup')
 
     def StartupTask_destroy(self):
-        set_settings(self.get_inputs())
+        inputs = self.valid_inputs()
+        if inputs is None:
+            return
+        set_settings(inputs)
         self.disable('startup')
         EmailBlocker.StartupTask.destroy()
         self.enable('startup')